@@ -0,0 +1,133 @@
+import concurrent.futures
+import csv
+import os
+from typing import Dict, List, Optional
+
+import cv2
+import numpy
+
+from channel_index import ChannelIndex, FrameSource
+from metrics import METRICS
+from segments import SegmentFrame, read_frames, split_runs
+
+# cached activity scores of a channel are kept in <channel dir>/index/activity.csv, a subdirectory so
+# that writing the cache doesn't change the channel directory (and invalidate its ChannelIndex)
+INDEX_DIR_NAME = 'index'
+ACTIVITY_FILE_NAME = 'activity.csv'
+
+# how much frames are shrunk before they are compared, libjpeg does this while decoding
+ACTIVITY_SHRINK_FACTOR = 8
+
+
+def activity_path(image_dir: str) -> str:
+    """Get the path of the file that caches a channel directory's activity scores"""
+
+    return os.path.join(image_dir, INDEX_DIR_NAME, ACTIVITY_FILE_NAME)
+
+
+def read_scores(image_dir: str) -> Dict[str, float]:
+    """Read a channel directory's cached activity scores, keyed by image name"""
+
+    try:
+        with open(activity_path(image_dir), newline='') as f:
+            rows = csv.reader(f)
+            next(rows, None)  # header
+            return {image_name: float(score) for image_name, score in rows}
+    except (FileNotFoundError, ValueError):  # nothing cached yet or a damaged cache
+        return {}
+
+
+def write_scores(image_dir: str, image_names: List[str], scores: numpy.ndarray):
+    """Replace a channel directory's cached activity scores"""
+
+    path = activity_path(image_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['image_name', 'score'])
+        writer.writerows((image_name, f'{score:.3f}') for image_name, score in zip(image_names, scores))
+    os.replace(f'{path}.tmp', path)
+
+
+def _decode_small(sources: List[FrameSource]) -> List[Optional[numpy.ndarray]]:
+    """Decode consecutive frames as shrunk grayscale images"""
+
+    images = []
+    for run in split_runs(sources):
+        if isinstance(run[0], SegmentFrame):
+            for frame in read_frames(run[0].segment_path, run[0].frame_number, len(run)):
+                if frame is not None:
+                    h, w = frame.shape[:2]
+                    frame = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+                                       (w // ACTIVITY_SHRINK_FACTOR, h // ACTIVITY_SHRINK_FACTOR),
+                                       interpolation=cv2.INTER_AREA)
+                images.append(frame)
+        else:
+            images.extend(cv2.imread(source, cv2.IMREAD_REDUCED_GRAYSCALE_8) for source in run)
+    return images
+
+
+def _score_run(sources: List[FrameSource], has_previous: bool) -> List[float]:
+    """Score a run of consecutive frames, the first source is only decoded to compare against"""
+
+    with METRICS.time('activity_stage_seconds', stage='score_chunk'):
+        images = _decode_small(sources)
+    scores = []
+    for previous, image in zip(images[:-1] if has_previous else [None] + images[:-1],
+                               images[1:] if has_previous else images):
+        if image is None:  # unreadable frame
+            scores.append(0.0)
+        elif previous is None or previous.shape != image.shape:  # first frame or the camera changed resolution
+            scores.append(0.0 if previous is None else 255.0)
+        else:
+            scores.append(float(cv2.absdiff(previous, image).mean()))
+    return scores
+
+
+def activity_scores(index: ChannelIndex, max_workers: Optional[int] = None, chunk_size: int = 256) -> numpy.ndarray:
+    """Score how much every frame of a channel differs from the frame before it
+
+    A frame's score is the mean absolute difference (0-255) between it and the previous frame,
+    both decoded as grayscale at 1/ACTIVITY_SHRINK_FACTOR of their size, which is cheap enough to
+    score a full day of images in minutes. The first frame scores 0. Scores are cached next to the
+    images (see activity_path()), so only frames that were recorded since the last call are decoded.
+
+    Parameters
+    ----------
+    index : ChannelIndex
+        The channel to score
+    max_workers : int, optional
+        How many threads decode frames, default is one per CPU
+    chunk_size : int, default=256
+        How many frames each decode task handles
+
+    Returns
+    -------
+    numpy.ndarray
+        The score of every frame in the index, in the same order
+    """
+
+    cached = read_scores(index.image_dir)
+    scores = numpy.array([cached.get(image_name, numpy.nan) for image_name in index.names], dtype=numpy.float64)
+    missing = numpy.flatnonzero(numpy.isnan(scores))
+    if len(missing) == 0:
+        return scores
+
+    # split the missing frames into runs of consecutive frames, each decoded along with the frame before it
+    runs = []
+    for run in numpy.split(missing, numpy.flatnonzero(numpy.diff(missing) != 1) + 1):
+        for start in range(0, len(run), chunk_size):
+            runs.append(run[start:start + chunk_size])
+
+    def score(run: numpy.ndarray) -> List[float]:
+        first = int(run[0])
+        has_previous = first > 0
+        return _score_run(index.sources[first - has_previous:int(run[-1]) + 1], has_previous)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for run, run_scores in zip(runs, executor.map(score, runs)):
+            scores[run] = run_scores
+    METRICS.inc('activity_frames_scored_total', len(missing))
+
+    write_scores(index.image_dir, index.names, scores)
+    return scores
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Thread
+from typing import Any, Callable, Dict, List, Literal, Optional, Sequence, Set
+
+from backpressure import CameraLimits
+from metrics import METRICS
+from recorder import Recorder
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRecorder(Recorder):
+    """A Recorder that captures from every camera with asyncio instead of one shared loop
+
+    Every camera gets its own task on an event loop that runs in a single background thread,
+    so a slow camera or a slow save never delays the other cameras. Blocking work (reading a
+    frame, JPEG encoding and writing to the disk) is offloaded to thread pools, and the number
+    of simultaneous disk writes is capped across all cameras. It's meant for nodes with many
+    (32-64) low-rate streams, and it has the same start_recording()/stop_recording() API as
+    Recorder. A camera that fails to read keeps being retried, and every failed read or save is
+    logged and counted in the recorder_camera_errors_total and recorder_task_failures_total metrics.
+
+    Attributes
+    ----------
+    max_concurrent_writes : int
+        The most images being written to the disk at the same time, across all cameras
+    max_pending_saves : int
+        The most images per camera that can be waiting to be encoded or written before
+        new frames from that camera are dropped
+    _loop : asyncio.AbstractEventLoop, optional
+        The event loop running in _recorder_thread while recording
+    _stop_requested : asyncio.Event, optional
+        An event that notifies the camera tasks to stop
+    """
+
+    def __init__(self, image_dirs: List[str], num_cameras: int, dt_offset: float, capture_delay: float,
+                 delete_old_images: bool = True, verbose: bool = True,
+                 camera_factory: Optional[Callable[[int], Any]] = None, proxy_factors: Sequence[int] = (),
+                 backend: Literal['rtsp', 'cv2'] = 'rtsp', max_concurrent_writes: int = 8, max_pending_saves: int = 4,
+                 max_workers: Optional[int] = None, adaptive: bool = False,
+                 camera_limits: Optional[Dict[int, CameraLimits]] = None):
+        """
+        Parameters
+        ----------
+        image_dirs : List[str]
+            The paths of both the root image directory and the channel directories
+        num_cameras : int
+            How many cameras there are
+        dt_offset : float
+            How many seconds to add (or subtract if the number is negative) to the timestamp
+            of the images to better align with the actual timestamps pasted on the images themselves
+        capture_delay : float
+            How many seconds to wait in between capturing images from each camera
+        delete_old_images : bool, default=True
+            Whether to delete the existing "images" directory (if True, the entirety of the directory
+            listed as the first index of image_dirs will be deleted)
+        verbose : bool, default=True
+            Whether to log to the console information about what is happening while the script is running
+        camera_factory : Callable[[int], Any], optional
+            Takes a channel number (starting at 1) and returns an object with read() and close() methods
+            that behave like rtsp.Client's, default connects to the cell's RTSP cameras
+        proxy_factors : Sequence[int], default=()
+            The factors to write additional shrunk copies (proxies) of every image at
+        backend : 'rtsp', 'cv2', default='rtsp'
+            Which client connects to the cameras when camera_factory isn't given (see Recorder)
+        max_concurrent_writes : int, default=8
+            The most images being written to the disk at the same time, across all cameras
+        max_pending_saves : int, default=4
+            The most images per camera that can be waiting to be encoded or written before
+            new frames from that camera are dropped
+        max_workers : int, optional
+            How many threads to use for reading frames and for encoding, default scales with
+            the number of cameras and CPUs
+        adaptive : bool, default=False
+            Whether to lower the JPEG quality and capture rate of low-priority cameras while the
+            disk or CPU can't keep up, and restore them once it can (see BackpressureController)
+        camera_limits : Dict[int, CameraLimits], optional
+            The priority and quality/rate bounds of the cameras when adaptive is True, keyed by
+            channel (starting at 1)
+        """
+
+        super().__init__(image_dirs, num_cameras, dt_offset, capture_delay, delete_old_images, verbose,
+                         camera_factory, proxy_factors, backend, adaptive, camera_limits)
+        self.max_concurrent_writes = max_concurrent_writes
+        self.max_pending_saves = max_pending_saves
+        self._max_workers = max_workers
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop_requested: Optional[asyncio.Event] = None
+
+    def _on_task_done(self, channel: int, kind: str, task: asyncio.Task):
+        """Log and count a camera or save task that failed, so its exception is never lost"""
+
+        if task.cancelled() or task.exception() is None:
+            return
+        METRICS.inc('recorder_task_failures_total', channel=channel, task=kind)
+        logger.error('ch%d %s task failed', channel, kind, exc_info=task.exception())
+
+    async def _save(self, channel: int, img, image_name: str, encode_executor: ThreadPoolExecutor,
+                    io_executor: ThreadPoolExecutor, disk_semaphore: asyncio.Semaphore):
+        """Encode and write a single image, never leaving a partially written file behind"""
+
+        loop = asyncio.get_running_loop()
+        files = await loop.run_in_executor(encode_executor, self._encode_images, img, channel, image_name)
+        async with disk_semaphore:
+            await loop.run_in_executor(io_executor, self._write_images, files, channel)
+        METRICS.inc('recorder_frames_written_total', channel=channel)
+
+    async def _record_camera(self, channel: int, camera, saves: Set[asyncio.Task],
+                             encode_executor: ThreadPoolExecutor, io_executor: ThreadPoolExecutor,
+                             disk_semaphore: asyncio.Semaphore):
+        """Capture from a single camera every capture_delay seconds until cancelled"""
+
+        loop = asyncio.get_running_loop()
+        camera_saves: Set[asyncio.Task] = set()
+        next_capture = loop.time()
+        while True:
+            start = time.perf_counter()
+            try:
+                img = await loop.run_in_executor(io_executor, camera.read)
+            except Exception as e:  # keep recording, the camera may come back
+                METRICS.inc('recorder_camera_errors_total', channel=channel)
+                logger.error('ch%d failed to read a frame: %r', channel, e)
+                img = None
+            METRICS.observe('recorder_stage_seconds', time.perf_counter() - start, stage='grab', channel=channel)
+
+            if img is None:
+                METRICS.inc('recorder_frames_dropped_total', channel=channel)
+            elif len(camera_saves) >= self.max_pending_saves:  # the disk or encoder can't keep up
+                METRICS.inc('recorder_frames_dropped_total', channel=channel)
+                METRICS.inc('recorder_saves_backlogged_total', channel=channel)
+            else:
+                METRICS.inc('recorder_frames_captured_total', channel=channel)
+                task = loop.create_task(self._save(channel, img, self._image_name(), encode_executor, io_executor,
+                                                   disk_semaphore))
+                task.add_done_callback(partial(self._on_task_done, channel, 'save'))
+                for task_set in (camera_saves, saves):
+                    task_set.add(task)
+                    task.add_done_callback(task_set.discard)
+            METRICS.set_gauge('recorder_pending_saves', len(camera_saves), channel=channel)
+
+            # wait for capture delay, skipping captures that were missed rather than bunching them up
+            next_capture += self._capture_delay(channel)
+            lag = loop.time() - next_capture
+            if lag > 0:
+                METRICS.inc('recorder_loop_overruns_total', channel=channel)
+                next_capture = loop.time()
+            if self.backpressure is not None:
+                self.backpressure.update(queue_depth=len(camera_saves), lag=max(0.0, lag))
+            await asyncio.sleep(next_capture - loop.time())
+
+    async def _record(self):
+        """Run every camera's task until stop_recording() is called, then shut down cleanly"""
+
+        self._stop_requested = asyncio.Event()
+        workers = self._max_workers or min(64, self.num_cameras + (os.cpu_count() or 1))
+        encode_executor = ThreadPoolExecutor(max_workers=self._max_workers or os.cpu_count(),
+                                             thread_name_prefix='encode')
+        io_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='camera-io')
+        disk_semaphore = asyncio.Semaphore(self.max_concurrent_writes)
+        saves: Set[asyncio.Task] = set()
+
+        camera_tasks = [asyncio.create_task(self._record_camera(i + 1, camera, saves, encode_executor, io_executor,
+                                                                disk_semaphore))
+                        for i, camera in enumerate(self.cameras)]
+        for i, task in enumerate(camera_tasks):
+            task.add_done_callback(partial(self._on_task_done, i + 1, 'camera'))
+        try:
+            await self._stop_requested.wait()
+        finally:
+            # stop capturing, but let images that were already captured finish saving
+            for task in camera_tasks:
+                task.cancel()
+            # failures are logged by _on_task_done(), this only waits for everything to finish
+            await asyncio.gather(*camera_tasks, return_exceptions=True)
+            await asyncio.gather(*saves, return_exceptions=True)
+            encode_executor.shutdown(wait=True)
+            io_executor.shutdown(wait=True)
+
+    def start_recording(self):
+        """Start recording and saving images to the disk"""
+
+        if self.verbose:
+            print('Starting to record')
+
+        self._loop = asyncio.new_event_loop()
+
+        def record():
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(self._record())
+            finally:
+                self._loop.close()
+
+        self._recorder_thread = Thread(target=record)
+        self._recorder_thread.start()
+
+    def stop_recording(self):
+        """Stop recording and saving images to the disk"""
+
+        # the event has to be set from inside the loop's thread
+        while self._stop_requested is None and self._recorder_thread.is_alive():
+            time.sleep(0.01)  # the loop hasn't started yet
+        if self._stop_requested is not None:
+            self._loop.call_soon_threadsafe(self._stop_requested.set)
+        self._recorder_thread.join()  # wait for thread to finish
+
+        # disconnect from the cameras
+        if self.verbose:
+            print('Finished recording')
+        for camera in self.cameras:
+            camera.close()
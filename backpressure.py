@@ -0,0 +1,242 @@
+import logging
+import time
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional
+
+from metrics import METRICS
+
+
+class CameraLimits(NamedTuple):
+    """How far the BackpressureController may degrade a single camera
+
+    Attributes
+    ----------
+    priority : int
+        Cameras with a lower priority are degraded first and recovered last
+    min_capture_delay : float, optional
+        The capture delay the camera runs at when there is no backpressure, default is the
+        Recorder's capture_delay
+    max_capture_delay : float, optional
+        The longest the capture delay can be raised to, default is 8 times min_capture_delay
+    min_jpeg_quality : int
+        The lowest the JPEG quality can be lowered to
+    max_jpeg_quality : int, optional
+        The JPEG quality the camera runs at when there is no backpressure, default is the
+        Recorder's JPEG_QUALITY
+    """
+
+    priority: int = 0
+    min_capture_delay: Optional[float] = None
+    max_capture_delay: Optional[float] = None
+    min_jpeg_quality: int = 40
+    max_jpeg_quality: Optional[int] = None
+
+
+class BackpressureController:
+    """Lowers the JPEG quality and capture rate of low-priority cameras while recording can't keep up
+
+    The recorder reports how long writes take (observe_write()) and how far behind it is
+    (update()). While writes take longer than max_write_seconds, too many saves are queued or
+    captures are late (on average by more than LAG_TOLERANCE of the capture delay), the
+    controller degrades one camera by one step every adjust_interval seconds: the
+    lowest-priority camera first has its JPEG quality lowered down to its minimum, then its
+    capture delay raised up to its maximum, before the next camera is touched. Once nothing has
+    been overloaded for recover_interval seconds, cameras are restored one step at a time in the
+    opposite order. Every adjustment is logged.
+
+    Attributes
+    ----------
+    limits : Dict[int, CameraLimits]
+        The limits of every camera, keyed by channel (starting at 1)
+    max_write_seconds : float
+        How long writing a single image may take on average before it counts as overloaded
+    max_queue_depth : int
+        How many saves may be waiting before it counts as overloaded
+    adjust_interval : float
+        The fewest seconds in between two adjustments
+    recover_interval : float
+        How many seconds without overload before cameras start being restored
+    logger : logging.Logger
+        Where adjustments are logged to
+    """
+
+    # how much the capture delay is multiplied (or divided) by and the JPEG quality changed by per step
+    DELAY_STEP = 1.5
+    QUALITY_STEP = 10
+
+    # captures that are late on average by more than this fraction of the capture delay count as overloaded
+    LAG_TOLERANCE = 0.1
+
+    # how quickly the write latency and lag averages follow new reports
+    _SMOOTHING = 0.2
+
+    def __init__(self, num_cameras: int, capture_delay: float, jpeg_quality: int,
+                 limits: Optional[Dict[int, CameraLimits]] = None, max_write_seconds: Optional[float] = None,
+                 max_queue_depth: int = 2, adjust_interval: float = 5.0, recover_interval: float = 30.0,
+                 logger: Optional[logging.Logger] = None):
+        """
+        Parameters
+        ----------
+        num_cameras : int
+            How many cameras there are
+        capture_delay : float
+            The Recorder's capture delay, the default min_capture_delay of every camera
+        jpeg_quality : int
+            The Recorder's JPEG quality, the default max_jpeg_quality of every camera
+        limits : Dict[int, CameraLimits], optional
+            The limits of the cameras, keyed by channel (starting at 1), cameras that aren't
+            included get CameraLimits()
+        max_write_seconds : float, optional
+            How long writing a single image may take on average before it counts as overloaded,
+            default is the share of capture_delay that each camera gets
+        max_queue_depth : int, default=2
+            How many saves may be waiting before it counts as overloaded
+        adjust_interval : float, default=5.0
+            The fewest seconds in between two adjustments
+        recover_interval : float, default=30.0
+            How many seconds without overload before cameras start being restored
+        logger : logging.Logger, optional
+            Where adjustments are logged to, default is this module's logger
+        """
+
+        self.limits: Dict[int, CameraLimits] = {}
+        for channel in range(1, num_cameras + 1):
+            camera_limits = (limits or {}).get(channel, CameraLimits())
+            min_delay = camera_limits.min_capture_delay or capture_delay
+            self.limits[channel] = camera_limits._replace(
+                min_capture_delay=min_delay,
+                max_capture_delay=camera_limits.max_capture_delay or 8 * min_delay,
+                max_jpeg_quality=camera_limits.max_jpeg_quality or jpeg_quality,
+            )
+        self.max_write_seconds = max_write_seconds or capture_delay / num_cameras
+        self.max_queue_depth = max_queue_depth
+        self.adjust_interval = adjust_interval
+        self.recover_interval = recover_interval
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._capture_delays = {channel: limit.min_capture_delay for channel, limit in self.limits.items()}
+        self._jpeg_qualities = {channel: limit.max_jpeg_quality for channel, limit in self.limits.items()}
+        self._write_seconds = 0.0
+        self._lag = 0.0
+        self._last_overload = float('-inf')
+        self._last_adjustment = float('-inf')
+        self._lock = Lock()
+        for channel in self.limits:
+            self._report(channel)
+
+    def capture_delay(self, channel: int) -> float:
+        """Get how many seconds a camera should currently wait in between captures"""
+
+        return self._capture_delays[channel]
+
+    def jpeg_quality(self, channel: int) -> int:
+        """Get the JPEG quality a camera's images should currently be encoded with"""
+
+        return self._jpeg_qualities[channel]
+
+    def observe_write(self, seconds: float):
+        """Report how long writing an image (and its proxies) took"""
+
+        with self._lock:
+            self._write_seconds += self._SMOOTHING * (seconds - self._write_seconds)
+
+    def update(self, queue_depth: int = 0, lag: float = 0.0, now: Optional[float] = None) -> bool:
+        """Report the recorder's load and adjust a camera if it's time to
+
+        This is cheap and meant to be called after every capture (or loop of captures).
+
+        Parameters
+        ----------
+        queue_depth : int, default=0
+            How many saves are waiting to be encoded or written
+        lag : float, default=0.0
+            How many seconds behind schedule the capture is
+        now : float, optional
+            The current time.monotonic(), mostly for testing
+
+        Returns
+        -------
+        bool
+            Whether a camera was adjusted
+        """
+
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._lag += self._SMOOTHING * (lag - self._lag)
+            reasons = []
+            if self._write_seconds > self.max_write_seconds:
+                reasons.append(f'writes take {self._write_seconds:.3f}s')
+            if queue_depth > self.max_queue_depth:
+                reasons.append(f'{queue_depth} saves are queued')
+            if self._lag > self.LAG_TOLERANCE * min(self._capture_delays.values()):
+                reasons.append(f'captures are {self._lag:.3f}s late')
+
+            if reasons:
+                self._last_overload = now
+                if now - self._last_adjustment < self.adjust_interval:
+                    return False
+                # also throttles the warning when every camera is already at its limits
+                self._last_adjustment = now
+                return self._degrade(', '.join(reasons))
+            if now - self._last_overload >= self.recover_interval and \
+                    now - self._last_adjustment >= self.adjust_interval:
+                adjusted = self._recover()
+                if adjusted:
+                    self._last_adjustment = now
+                return adjusted
+            return False
+
+    def _degrade_order(self) -> List[int]:
+        """The channels ordered from least to most important (higher channels first on ties)"""
+
+        return sorted(self.limits, key=lambda channel: (self.limits[channel].priority, -channel))
+
+    def _degrade(self, reason: str) -> bool:
+        """Lower the quality or rate of the least important camera that still can be"""
+
+        for channel in self._degrade_order():
+            limit = self.limits[channel]
+            if self._jpeg_qualities[channel] > limit.min_jpeg_quality:
+                old = self._jpeg_qualities[channel]
+                self._jpeg_qualities[channel] = max(limit.min_jpeg_quality, old - self.QUALITY_STEP)
+                self.logger.warning('Recording can\'t keep up (%s): lowered ch%d JPEG quality from %d to %d',
+                                    reason, channel, old, self._jpeg_qualities[channel])
+            elif self._capture_delays[channel] < limit.max_capture_delay:
+                old = self._capture_delays[channel]
+                self._capture_delays[channel] = min(limit.max_capture_delay, old * self.DELAY_STEP)
+                self.logger.warning('Recording can\'t keep up (%s): raised ch%d capture delay from %.3fs to %.3fs',
+                                    reason, channel, old, self._capture_delays[channel])
+            else:
+                continue
+            METRICS.inc('recorder_backpressure_adjustments_total', direction='degrade', channel=channel)
+            self._report(channel)
+            return True
+
+        self.logger.warning('Recording can\'t keep up (%s) and every camera is at its limits', reason)
+        return False
+
+    def _recover(self) -> bool:
+        """Raise the rate or quality of the most important camera that is degraded"""
+
+        for channel in reversed(self._degrade_order()):
+            limit = self.limits[channel]
+            if self._capture_delays[channel] > limit.min_capture_delay:
+                old = self._capture_delays[channel]
+                self._capture_delays[channel] = max(limit.min_capture_delay, old / self.DELAY_STEP)
+                self.logger.info('Recording has caught up: lowered ch%d capture delay from %.3fs to %.3fs',
+                                 channel, old, self._capture_delays[channel])
+            elif self._jpeg_qualities[channel] < limit.max_jpeg_quality:
+                old = self._jpeg_qualities[channel]
+                self._jpeg_qualities[channel] = min(limit.max_jpeg_quality, old + self.QUALITY_STEP)
+                self.logger.info('Recording has caught up: raised ch%d JPEG quality from %d to %d',
+                                 channel, old, self._jpeg_qualities[channel])
+            else:
+                continue
+            METRICS.inc('recorder_backpressure_adjustments_total', direction='recover', channel=channel)
+            self._report(channel)
+            return True
+        return False
+
+    def _report(self, channel: int):
+        METRICS.set_gauge('recorder_capture_delay_seconds', self._capture_delays[channel], channel=channel)
+        METRICS.set_gauge('recorder_jpeg_quality', self._jpeg_qualities[channel], channel=channel)
@@ -0,0 +1,375 @@
+"""Reproducible benchmarks for the capture, indexing and rendering paths
+
+Every run generates a synthetic recording (NUM_CAMERAS channels of JPEGs with deterministic
+content and timestamps) in a temporary directory and then runs each benchmark case in its own
+fresh process, so caches and peak RSS don't leak from one case into the next. The results are
+written as JSON and can be compared against the results of a previous run:
+
+    python benchmark.py --frames 300 --width 1280 --height 720 --output new.json --compare old.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+import cv2
+import numpy
+from PIL import Image
+
+START_DT = datetime(2022, 8, 8, 9, 0)
+
+
+def generate_recording(root: str, num_frames: int, width: int, height: int, capture_delay: float = 0.5,
+                       seed: int = 0):
+    """Write a synthetic recording with the same layout the Recorder produces
+
+    Parameters
+    ----------
+    root : str
+        The directory to create the recording's "images" directory in
+    num_frames : int
+        How many images to write per channel
+    width : int
+        The width of each image
+    height : int
+        The height of each image
+    capture_delay : float, default=0.5
+        How many seconds apart consecutive images of a channel are
+    seed : int, default=0
+        The seed for the image content and timestamp jitter, so that runs are comparable
+    """
+
+    from image_collection import PIC_DIRS
+
+    rng = numpy.random.default_rng(seed)
+    jitter = random.Random(seed)
+    background = rng.integers(0, 256, (height, width, 3), dtype=numpy.uint8)
+
+    for image_dir in PIC_DIRS:
+        os.makedirs(os.path.join(root, image_dir), exist_ok=True)
+
+    for channel, image_dir in enumerate(PIC_DIRS[1:]):
+        for i in range(num_frames):
+            # a moving block over static noise keeps the JPEGs a realistic size
+            frame = numpy.roll(background, channel * 7, axis=1)
+            x = (i * 16 + channel * 40) % max(1, width - height // 4)
+            frame[height // 3:height // 3 + height // 4, x:x + height // 4] = (channel * 30) % 256
+
+            dt = START_DT + timedelta(seconds=i * capture_delay + jitter.uniform(0, capture_delay / 10))
+            timestamp = str(dt).replace(':', '_')
+            if '.' not in timestamp:  # str() leaves off the microseconds when they are 0
+                timestamp += '.000000'
+            cv2.imwrite(os.path.join(root, image_dir, f'{timestamp}.jpg'), frame)
+
+
+class FakeCamera:
+    """A stand-in for rtsp.Client (or Cv2Client) that returns synthetic images at full speed
+
+    Attributes
+    ----------
+    channel : int
+        The channel this camera pretends to be
+    """
+
+    def __init__(self, channel: int, width: int = 1280, height: int = 720, latency: float = 0.0,
+                 bgr: bool = False):
+        """
+        Parameters
+        ----------
+        channel : int
+            The channel this camera pretends to be
+        width : int, default=1280
+            The width of the returned images
+        height : int, default=720
+            The height of the returned images
+        latency : float, default=0.0
+            How many seconds each read() should take
+        bgr : bool, default=False
+            Whether to return BGR numpy arrays like Cv2Client instead of PIL Images like rtsp.Client
+        """
+
+        self.channel = channel
+        self._latency = latency
+        rng = numpy.random.default_rng(channel)
+        frame = rng.integers(0, 256, (height, width, 3), dtype=numpy.uint8)
+        self._image = frame if bgr else Image.fromarray(frame)
+
+    def read(self):
+        if self._latency:
+            time.sleep(self._latency)
+        return self._image
+
+    def close(self):
+        pass
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    """Summarize latency samples (in seconds) as milliseconds"""
+
+    ordered = sorted(samples)
+    return {
+        'mean_ms': statistics.mean(ordered) * 1000,
+        'p50_ms': ordered[len(ordered) // 2] * 1000,
+        'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def bench_from_timestamp(args: argparse.Namespace) -> Dict[str, Any]:
+    from image_collection import ImageCollection
+
+    rng = random.Random(args.seed)
+    total_seconds = args.frames * args.capture_delay
+    samples = []
+    for _ in range(args.lookups):
+        dt = START_DT + timedelta(seconds=rng.uniform(0, total_seconds))
+        start = time.perf_counter()
+        ImageCollection.from_timestamp(dt, 1)
+        samples.append(time.perf_counter() - start)
+    return {'lookups': len(samples), **_percentiles(samples)}
+
+
+def bench_from_index(args: argparse.Namespace) -> Dict[str, Any]:
+    from image_collection import ImageCollection
+
+    rng = random.Random(args.seed)
+    samples = []
+    for _ in range(args.lookups):
+        index = rng.randrange(args.frames)
+        start = time.perf_counter()
+        ImageCollection.from_index(index)
+        samples.append(time.perf_counter() - start)
+    return {'lookups': len(samples), **_percentiles(samples)}
+
+
+def bench_grid_render(args: argparse.Namespace) -> Dict[str, Any]:
+    from frame_cache import FRAME_CACHE
+    from image_collection import ImageCollection
+
+    collections = [ImageCollection.from_index(i) for i in range(min(args.frames, args.lookups))]
+
+    results = {}
+    for label in ['cold', 'warm']:
+        if label == 'cold':
+            FRAME_CACHE.clear()
+        start = time.perf_counter()
+        for collection in collections:
+            collection.to_cv2_image_grid(args.shrink_factor)
+        elapsed = time.perf_counter() - start
+        results[f'{label}_grids_per_s'] = len(collections) / elapsed
+    results['cache'] = FRAME_CACHE.stats()
+    return results
+
+
+def bench_single_channel(args: argparse.Namespace) -> Dict[str, Any]:
+    import video_creator
+
+    start = time.perf_counter()
+    video_creator.single_channel(1, 'images', 'single_channel.avi', fps=2)
+    elapsed = time.perf_counter() - start
+    return {'frames': args.frames, 'seconds': elapsed, 'fps': args.frames / elapsed}
+
+
+def bench_all_channels(args: argparse.Namespace) -> Dict[str, Any]:
+    import video_creator
+
+    fps = 2
+    start = time.perf_counter()
+    video_creator.all_channels('images', 'all_channels.avi', fps=fps)
+    elapsed = time.perf_counter() - start
+    frames = int((args.frames - 1) * args.capture_delay * fps)
+    return {'frames': frames, 'seconds': elapsed, 'fps': frames / elapsed}
+
+
+def bench_recorder(args: argparse.Namespace, bgr: bool = False) -> Dict[str, Any]:
+    from image_collection import NUM_CAMERAS, PIC_DIRS
+    from recorder import Recorder
+
+    def camera_factory(channel: int) -> FakeCamera:
+        return FakeCamera(channel, args.width, args.height, bgr=bgr)
+
+    image_dirs = [os.path.join('recorder', image_dir) for image_dir in PIC_DIRS]
+    os.mkdir('recorder')
+    recorder = Recorder(image_dirs, NUM_CAMERAS, 0, 0.0, True, False, camera_factory=camera_factory)
+    start = time.perf_counter()
+    recorder.start_recording()
+    time.sleep(args.record_seconds)
+    recorder.stop_recording()
+    elapsed = time.perf_counter() - start
+
+    written = [os.path.join(image_dir, name) for image_dir in image_dirs[1:] for name in os.listdir(image_dir)]
+    written_bytes = sum(os.path.getsize(path) for path in written)
+    return {
+        'frames': len(written),
+        'seconds': elapsed,
+        'frames_per_s': len(written) / elapsed,
+        'mb_per_s': written_bytes / elapsed / 1e6,
+    }
+
+
+def bench_recorder_bgr(args: argparse.Namespace) -> Dict[str, Any]:
+    return bench_recorder(args, bgr=True)
+
+
+BENCHMARKS: Dict[str, Callable[[argparse.Namespace], Dict[str, Any]]] = {
+    'from_timestamp': bench_from_timestamp,
+    'from_index': bench_from_index,
+    'grid_render': bench_grid_render,
+    'single_channel': bench_single_channel,
+    'all_channels': bench_all_channels,
+    'recorder': bench_recorder,
+    'recorder_bgr': bench_recorder_bgr,
+}
+
+
+def _peak_rss_mb() -> Optional[float]:
+    """Get the peak resident set size of this process in MB, or None if it's unavailable"""
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / 1e6 if platform.system() == 'Darwin' else peak / 1e3
+
+
+def _run_case(name: str, recording_dir: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Run a single benchmark inside a copy of the recording (executed in a fresh process)"""
+
+    work_dir = tempfile.mkdtemp(prefix=f'bench-{name}-')
+    original_dir = os.getcwd()
+    try:
+        shutil.copytree(os.path.join(recording_dir, 'images'), os.path.join(work_dir, 'images'))
+        os.chdir(work_dir)
+        result = BENCHMARKS[name](args)
+        result['peak_rss_mb'] = _peak_rss_mb()
+        return result
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Generate a recording and run the selected benchmarks against it
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The parsed command-line arguments
+
+    Returns
+    -------
+    Dict[str, Any]
+        The run's metadata and the results of every benchmark
+    """
+
+    recording_dir = tempfile.mkdtemp(prefix='bench-recording-')
+    results = {}
+    try:
+        generate_recording(recording_dir, args.frames, args.width, args.height, args.capture_delay, args.seed)
+        context = multiprocessing.get_context('spawn')
+        for name in args.only or BENCHMARKS:
+            if args.verbose:
+                print(f'Running {name}')
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                results[name] = executor.submit(_run_case, name, recording_dir, args).result()
+    finally:
+        shutil.rmtree(recording_dir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'created': datetime.now().isoformat(),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'opencv': cv2.__version__,
+            'numpy': numpy.__version__,
+            'params': {key: value for key, value in vars(args).items() if key not in ['output', 'compare', 'verbose']},
+        },
+        'results': results,
+    }
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> List[str]:
+    """Describe the relative change of every numeric metric that appears in both runs
+
+    Parameters
+    ----------
+    old : Dict[str, Any]
+        The results of the baseline run
+    new : Dict[str, Any]
+        The results of the run to compare against the baseline
+
+    Returns
+    -------
+    List[str]
+        One formatted line per metric
+    """
+
+    if old['meta']['params'] != new['meta']['params']:
+        print('Warning: the runs used different parameters, so they may not be comparable')
+
+    lines = []
+    for name, new_metrics in new['results'].items():
+        old_metrics = old['results'].get(name, {})
+        for metric, new_value in new_metrics.items():
+            old_value = old_metrics.get(metric)
+            if isinstance(new_value, (int, float)) and isinstance(old_value, (int, float)) and old_value:
+                change = (new_value - old_value) / old_value * 100
+                lines.append(f'{name}.{metric}: {old_value:.4g} -> {new_value:.4g} ({change:+.1f}%)')
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=120, help='images per channel in the synthetic recording')
+    parser.add_argument('--width', type=int, default=1280, help='width of the synthetic images')
+    parser.add_argument('--height', type=int, default=720, help='height of the synthetic images')
+    parser.add_argument('--capture-delay', type=float, default=0.5, help='seconds between synthetic images')
+    parser.add_argument('--lookups', type=int, default=50, help='lookups/grids per latency benchmark')
+    parser.add_argument('--shrink-factor', type=int, default=2, help='shrink factor used for grids')
+    parser.add_argument('--record-seconds', type=float, default=5.0, help='how long to run the recorder')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic recording')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='only run these benchmarks')
+    parser.add_argument('--output', default='bench_output.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='a previous JSON results file to compare against')
+    parser.add_argument('--verbose', action='store_true', help='log which benchmark is running')
+    args = parser.parse_args()
+
+    report = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report['results'], indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\n'.join(compare(baseline, report)))
+
+
+if __name__ == '__main__':
+    main()
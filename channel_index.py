@@ -0,0 +1,167 @@
+import os
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy
+
+from segments import SegmentFrame, list_segments, read_table, segments_dir
+
+# a frame is either the path of a loose JPEG or a frame inside a compacted segment
+FrameSource = Union[str, SegmentFrame]
+
+
+def timestamps_from_image_names(image_names: List[str]) -> numpy.ndarray:
+    """Convert image names (like '2022-08-08 11_14_44.126554.jpg') to an array of datetime64[us]
+
+    This is the vectorized equivalent of ImageCollection.datetime_from_image_name()
+    """
+
+    iso_strings = [os.path.splitext(name)[0].replace(' ', 'T').replace('_', ':') for name in image_names]
+    return numpy.array(iso_strings, dtype='datetime64[us]')
+
+
+def nearest_index(timestamps: numpy.ndarray, timestamp: datetime, max_seconds_apart: float = 1) -> Optional[int]:
+    """Get the position of the timestamp closest to a target timestamp
+
+    Parameters
+    ----------
+    timestamps : numpy.ndarray
+        The timestamps to search as datetime64[us], in increasing order
+    timestamp : datetime
+        The target timestamp
+    max_seconds_apart : float, default=1
+        Ignore timestamps too many seconds away from the target, even if it's the closest one
+
+    Returns
+    -------
+    int, optional
+        The position of the closest timestamp or None if there isn't one close enough
+    """
+
+    if len(timestamps) == 0:
+        return None
+
+    target = numpy.datetime64(timestamp, 'us')
+    right = int(numpy.searchsorted(timestamps, target))
+    candidates = [i for i in (right - 1, right) if 0 <= i < len(timestamps)]
+    closest = min(candidates, key=lambda i: abs(timestamps[i] - target))
+    if abs(timestamps[closest] - target) <= numpy.timedelta64(timedelta(seconds=max_seconds_apart)):
+        return closest
+    return None
+
+
+class ChannelIndex:
+    """Every frame recorded for a single channel, loose JPEGs and compacted segments alike, sorted by time
+
+    Indexes should be created with ChannelIndex.load(), which reuses an index for as long as
+    its channel directory hasn't changed.
+
+    Attributes
+    ----------
+    image_dir : str
+        The channel directory that was indexed
+    timestamps : numpy.ndarray
+        The timestamp of every frame as datetime64[us], in increasing order
+    names : List[str]
+        The (original) image name of every frame
+    sources : List[FrameSource]
+        Where to read every frame from
+    """
+
+    _cache: Dict[str, Tuple[Tuple[int, int], 'ChannelIndex']] = {}
+    _cache_lock = Lock()
+
+    def __init__(self, image_dir: str, names: List[str], sources: List[FrameSource]):
+        self.image_dir = image_dir
+        self.names = names
+        self.sources = sources
+        self.timestamps = timestamps_from_image_names(names)
+
+    def __len__(self) -> int:
+        return len(self.sources)
+
+    def __getitem__(self, index: int) -> FrameSource:
+        return self.sources[index]
+
+    @staticmethod
+    def _version(image_dir: str) -> Tuple[int, int]:
+        """Anything that adds or removes images changes the mtime of one of these directories"""
+
+        try:
+            segments_mtime = os.stat(segments_dir(image_dir)).st_mtime_ns
+        except FileNotFoundError:
+            segments_mtime = 0
+        return os.stat(image_dir).st_mtime_ns, segments_mtime
+
+    @classmethod
+    def build(cls, image_dir: str) -> 'ChannelIndex':
+        """Index a channel directory from scratch
+
+        Parameters
+        ----------
+        image_dir : str
+            The channel directory to index
+
+        Returns
+        -------
+        ChannelIndex
+        """
+
+        frames: Dict[str, FrameSource] = {}
+        for segment_path in list_segments(image_dir):
+            for frame_number, image_name in enumerate(read_table(segment_path)):
+                frames[image_name] = SegmentFrame(segment_path, frame_number)
+
+        # a loose JPEG wins over a segment frame with the same name (a compaction that didn't finish)
+        for image_name in os.listdir(image_dir):
+            if image_name.endswith('.jpg'):
+                frames[image_name] = os.path.join(image_dir, image_name)
+
+        names = sorted(frames)
+        return cls(image_dir, names, [frames[name] for name in names])
+
+    @classmethod
+    def load(cls, image_dir: str) -> 'ChannelIndex':
+        """Get the index of a channel directory, only rebuilding it if the directory has changed
+
+        Parameters
+        ----------
+        image_dir : str
+            The channel directory to index
+
+        Returns
+        -------
+        ChannelIndex
+        """
+
+        version = cls._version(image_dir)
+        with cls._cache_lock:
+            cached = cls._cache.get(image_dir)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        index = cls.build(image_dir)
+        with cls._cache_lock:
+            cls._cache[image_dir] = (version, index)
+        return index
+
+    def nearest(self, timestamp: datetime, max_seconds_apart: float = 1) -> Optional[FrameSource]:
+        """Get the frame closest to a timestamp
+
+        Parameters
+        ----------
+        timestamp : datetime
+            The target timestamp
+        max_seconds_apart : float, default=1
+            Ignore frames with timestamps too many seconds away from the target,
+            even if it's the closest one
+
+        Returns
+        -------
+        FrameSource, optional
+            The closest frame or None if there isn't one close enough
+        """
+
+        closest = nearest_index(self.timestamps, timestamp, max_seconds_apart)
+        return None if closest is None else self.sources[closest]
@@ -0,0 +1,356 @@
+"""A single non-interactive entry point for recording and working with recorded images
+
+Usage: python cli.py [--config CONFIG] {record,index,render,export,stats} [options]
+
+Run a subcommand with --help to see its options. Options can also be given in a JSON config
+file, either at the top level (applied to every subcommand) or in a section named after the
+subcommand, and flags on the command line override the config file:
+
+    {"images_dir": "images", "record": {"capture_delay": 0.5, "dt_offset": 4, "max_gb": 200}}
+
+Nothing heavy (cv2, PIL, NumPy) is imported until the chosen subcommand needs it, so light
+commands like stats start almost instantly.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import sys
+import time
+from datetime import datetime, timedelta
+from threading import Event
+from typing import Any, Dict, List, Optional, Union
+
+COMMANDS = ('record', 'index', 'render', 'export', 'stats')
+
+
+def _fps(value: str) -> Union[float, str]:
+    return value if value == 'auto' else float(value)
+
+
+def _channels(args: argparse.Namespace) -> List[int]:
+    """The channels selected with --channels, default is every channel directory that exists"""
+
+    if args.channels:
+        return args.channels
+    return sorted(int(name[2:]) for name in os.listdir(args.images_dir)
+                  if name.startswith('ch') and name[2:].isdigit() and
+                  os.path.isdir(os.path.join(args.images_dir, name)))
+
+
+def _print(result: Any, as_json: bool = True):
+    if as_json:
+        print(json.dumps(result, indent=2, default=str))
+    elif isinstance(result, list):
+        print('\n'.join(map(str, result)))
+    else:
+        print(result)
+
+
+def record(args: argparse.Namespace):
+    """Record until --duration seconds have passed or the process is interrupted (Ctrl+C or SIGTERM)"""
+
+    from metrics import METRICS, JsonFileSink, PrometheusSink
+
+    if args.use_async:
+        from async_recorder import AsyncRecorder as RecorderClass
+    else:
+        from recorder import Recorder as RecorderClass
+
+    image_dirs = [args.images_dir] + [os.path.join(args.images_dir, f'ch{i + 1}') for i in range(args.num_cameras)]
+    verbose = not args.quiet
+
+    if args.metrics_file or args.metrics_port is not None:
+        METRICS.enable()
+        if args.metrics_file:
+            METRICS.add_sink(JsonFileSink(args.metrics_file))
+        if args.metrics_port is not None:
+            METRICS.add_sink(PrometheusSink(args.metrics_port))
+        METRICS.start_exporting(args.metrics_interval)
+
+    recorder = RecorderClass(image_dirs, args.num_cameras, args.dt_offset, args.capture_delay,
+                             args.delete_old_images, verbose, proxy_factors=args.proxy_factors,
+                             backend=args.backend, adaptive=args.adaptive)
+
+    # maintenance that runs in the background while recording
+    background = []
+    if args.compact_minutes:
+        from compactor import Compactor
+        background.append(Compactor(image_dirs, segment_seconds=int(args.compact_minutes * 60), verbose=verbose))
+    if args.max_gb or args.max_age_hours or args.min_free_gb:
+        from retention import RetentionManager
+        background.append(RetentionManager(
+            image_dirs,
+            max_bytes=int(args.max_gb * 1024 ** 3) if args.max_gb else None,
+            max_age=timedelta(hours=args.max_age_hours) if args.max_age_hours else None,
+            min_free_bytes=int(args.min_free_gb * 1024 ** 3) if args.min_free_gb else None,
+            verbose=verbose,
+        ))
+
+    stop = Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: stop.set())
+
+    recorder.start_recording()
+    for task in background:
+        task.start()
+    try:
+        # wait in short steps so signals are handled promptly on every platform
+        deadline = time.monotonic() + args.duration if args.duration else None
+        while not stop.wait(0.5):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+    finally:
+        recorder.stop_recording()
+        for task in background:
+            task.stop()
+        if METRICS.enabled:
+            METRICS.stop_exporting()
+
+
+def index(args: argparse.Namespace):
+    """Index (or re-index) channel directories and print what they contain"""
+
+    from channel_index import ChannelIndex
+    from segments import SegmentFrame
+    from timeline import planned_fps
+
+    at = datetime.fromisoformat(args.at) if args.at else None
+    results = []
+    for channel in _channels(args):
+        channel_index = ChannelIndex.load(os.path.join(args.images_dir, f'ch{channel}'))
+        segments = {source.segment_path for source in channel_index.sources if isinstance(source, SegmentFrame)}
+        result = {
+            'channel': channel,
+            'frames': len(channel_index),
+            'segments': len(segments),
+            'first': str(channel_index.timestamps[0]) if len(channel_index) else None,
+            'last': str(channel_index.timestamps[-1]) if len(channel_index) else None,
+            'fps': round(planned_fps(channel_index.timestamps), 3) if len(channel_index) > 1 else None,
+        }
+        if at is not None:
+            result['nearest'] = channel_index.nearest(at, args.max_seconds_apart)
+        if args.activity:
+            from activity import activity_scores
+            scores = activity_scores(channel_index, args.max_workers)
+            result['mean_activity'] = round(float(scores.mean()), 3) if len(scores) else None
+        results.append(result)
+
+    if args.json:
+        _print(results)
+        return
+    for result in results:
+        print(f"ch{result['channel']}: {result['frames']} frames ({result['segments']} segments), "
+              f"{result['first']} - {result['last']}, {result['fps']} fps" +
+              (f", nearest: {result['nearest']}" if 'nearest' in result else '') +
+              (f", mean activity: {result['mean_activity']}" if 'mean_activity' in result else ''))
+
+
+def render(args: argparse.Namespace):
+    """Render a video (or contact sheets) from the recorded images"""
+
+    if args.kind == 'sheets':
+        from contact_sheet import contact_sheets
+        _print(contact_sheets(args.images_dir, args.output, args.interval_minutes, args.shrink_factor,
+                              args.columns, args.rows, args.max_workers), as_json=False)
+        return
+
+    import video_creator
+
+    try:
+        if args.kind == 'channel':
+            report = video_creator.single_channel(args.channel, args.images_dir, args.output, args.fps,
+                                                  args.timestamp_faithful)
+        elif args.kind == 'grid':
+            report = video_creator.all_channels(args.images_dir, args.output, args.fps)
+        else:
+            report = video_creator.summary(args.images_dir, args.output, args.fps, args.activity_threshold,
+                                           args.idle_speedup, args.padding_seconds, args.max_workers)
+    except IOError as error:  # no video was written, so don't report one
+        sys.exit(f'render: {error}')
+    if report is not None:
+        _print(report)
+
+
+def export(args: argparse.Namespace):
+    """Export every channel as a video or into a memory-mapped frame store"""
+
+    if args.kind == 'videos':
+        from video_creator import export_all_channels
+        paths = export_all_channels(args.images_dir, args.output_dir, args.fps, _channels(args), args.max_workers)
+    else:
+        from frame_store import export_frame_store
+        paths = export_frame_store(args.images_dir, args.output_dir, args.shrink_factor, _channels(args),
+                                   args.max_workers)
+    _print(paths, as_json=False)
+
+
+def stats(args: argparse.Namespace):
+    """Print how many images each channel has and how much disk space they take up"""
+
+    def usage(path: str) -> Dict[str, int]:
+        files = total = 0
+        for root, _, names in os.walk(path):
+            for name in names:
+                files += 1
+                total += os.path.getsize(os.path.join(root, name))
+        return {'files': files, 'bytes': total}
+
+    results: Dict[str, Any] = {'channels': []}
+    for channel in _channels(args):
+        image_dir = os.path.join(args.images_dir, f'ch{channel}')
+        images = [entry for entry in os.scandir(image_dir) if entry.name.endswith('.jpg')]
+        names = sorted(entry.name for entry in images)
+        results['channels'].append({
+            'channel': channel,
+            'images': len(images),
+            'image_bytes': sum(entry.stat().st_size for entry in images),
+            'first_image': names[0] if names else None,
+            'last_image': names[-1] if names else None,
+            'segments': usage(os.path.join(image_dir, 'segments')),
+            'proxies': usage(os.path.join(image_dir, 'proxies')),
+        })
+    results['total_bytes'] = usage(args.images_dir)['bytes']
+    results['free_bytes'] = shutil.disk_usage(args.images_dir).free
+    if args.metrics_file:
+        with open(args.metrics_file) as f:
+            results['metrics'] = json.load(f)
+
+    if args.json:
+        _print(results)
+        return
+    for result in results['channels']:
+        print(f"ch{result['channel']}: {result['images']} images ({result['image_bytes'] / 1024 ** 2:.1f} MiB), "
+              f"{result['segments']['files']} segment files ({result['segments']['bytes'] / 1024 ** 2:.1f} MiB), "
+              f"{result['proxies']['files']} proxies ({result['proxies']['bytes'] / 1024 ** 2:.1f} MiB), "
+              f"{result['first_image']} - {result['last_image']}")
+    print(f"total: {results['total_bytes'] / 1024 ** 2:.1f} MiB" +
+          f", free: {results['free_bytes'] / 1024 ** 3:.1f} GiB")
+    if 'metrics' in results:
+        _print(results['metrics'])
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build the argument parser with one subparser per command in COMMANDS"""
+
+    parser = argparse.ArgumentParser(prog='cli.py', description='Record and work with IP camera images.')
+    parser.add_argument('--config', help='a JSON file with default options (flags override it)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--images-dir', default='images', help='the root directory of all the images')
+    common.add_argument('--config', help=argparse.SUPPRESS)  # read by main() before parsing, also allowed here
+
+    channels = argparse.ArgumentParser(add_help=False)
+    channels.add_argument('--channels', type=int, nargs='+', help='the channels to use, default is every channel')
+
+    workers = argparse.ArgumentParser(add_help=False)
+    workers.add_argument('--max-workers', type=int, help='how many threads to use, default is one per CPU')
+
+    fps = argparse.ArgumentParser(add_help=False)
+    fps.add_argument('--fps', type=_fps, default='auto', help="the video's framerate or 'auto'")
+
+    as_json = argparse.ArgumentParser(add_help=False)
+    as_json.add_argument('--json', action='store_true', help='print the results as JSON')
+
+    p = subparsers.add_parser('record', parents=[common], help='record images from the cameras')
+    p.add_argument('--num-cameras', type=int, default=8, help='how many cameras there are')
+    p.add_argument('--capture-delay', type=float, default=0.5, help='seconds in between captures')
+    p.add_argument('--dt-offset', type=float, default=4, help="seconds to add to the images' timestamps")
+    p.add_argument('--duration', type=float, help='seconds to record for, default is until interrupted')
+    p.add_argument('--delete-old-images', action='store_true', help='delete the existing images directory first')
+    p.add_argument('--quiet', action='store_true', help="don't log what is happening to the console")
+    p.add_argument('--backend', choices=('rtsp', 'cv2'), default='rtsp', help='the client that reads the cameras')
+    p.add_argument('--proxy-factors', type=int, nargs='*', default=[], help='write shrunk copies at these factors')
+    p.add_argument('--async', dest='use_async', action='store_true', help='use AsyncRecorder (for many cameras)')
+    p.add_argument('--adaptive', action='store_true', help='lower quality/rate of cameras while overloaded')
+    p.add_argument('--compact-minutes', type=float, help='compact images into video segments of this many minutes')
+    p.add_argument('--max-gb', type=float, help='delete the oldest images beyond this many GiB')
+    p.add_argument('--max-age-hours', type=float, help='delete images older than this many hours')
+    p.add_argument('--min-free-gb', type=float, help='delete the oldest images to keep this many GiB free')
+    p.add_argument('--metrics-file', help='enable metrics and write them to this JSON file')
+    p.add_argument('--metrics-port', type=int, help='enable metrics and serve them for Prometheus on this port')
+    p.add_argument('--metrics-interval', type=float, default=10.0, help='seconds in between metrics exports')
+    p.set_defaults(func=record)
+
+    p = subparsers.add_parser('index', parents=[common, channels, workers, as_json],
+                              help='index channel directories and print what they contain')
+    p.add_argument('--at', help='also find every channel\'s image closest to this ISO timestamp')
+    p.add_argument('--max-seconds-apart', type=float, default=1, help='how far away the image for --at may be')
+    p.add_argument('--activity', action='store_true', help='also score (and cache) the activity of every image')
+    p.set_defaults(func=index)
+
+    p = subparsers.add_parser('render', parents=[common, workers, fps], help='render a video or contact sheets')
+    p.add_argument('kind', choices=('channel', 'grid', 'summary', 'sheets'),
+                   help='a single channel, a grid of every channel, a grid summary that speeds through idle '
+                        'periods or paged contact sheets')
+    p.add_argument('--output', help='the video file (or, for sheets, the directory) to create')
+    p.add_argument('--channel', type=int, default=1, help='the channel to render (channel)')
+    p.add_argument('--timestamp-faithful', action='store_true', help='play back in step with wall time (channel)')
+    p.add_argument('--activity-threshold', type=float, default=2.0, help='what counts as activity (summary)')
+    p.add_argument('--idle-speedup', type=int, default=20, help='how much faster idle periods play (summary)')
+    p.add_argument('--padding-seconds', type=float, default=2.0, help='normal speed around activity (summary)')
+    p.add_argument('--interval-minutes', type=float, default=10, help='minutes in between grids (sheets)')
+    p.add_argument('--shrink-factor', type=int, default=8, help='how much to shrink the tiles (sheets)')
+    p.add_argument('--columns', type=int, default=4, help='grids next to each other on a page (sheets)')
+    p.add_argument('--rows', type=int, default=6, help='grids on top of each other on a page (sheets)')
+    p.set_defaults(func=render)
+
+    p = subparsers.add_parser('export', parents=[common, channels, workers, fps],
+                              help='export every channel as a video or into a frame store')
+    p.add_argument('kind', choices=('videos', 'frames'),
+                   help='one video per channel or memory-mapped NumPy arrays for analysis')
+    p.add_argument('--output-dir', help='the directory to export to')
+    p.add_argument('--shrink-factor', type=int, default=1, help='how much to shrink the frames (frames)')
+    p.set_defaults(func=export)
+
+    p = subparsers.add_parser('stats', parents=[common, channels, as_json], help='print disk usage per channel')
+    p.add_argument('--metrics-file', help='also print the metrics a recording wrote to this JSON file')
+    p.set_defaults(func=stats)
+
+    return parser
+
+
+def load_config(parser: argparse.ArgumentParser, path: str):
+    """Use a JSON config file's options as the defaults of the subcommands"""
+
+    with open(path) as f:
+        config: Dict[str, Any] = json.load(f)
+    shared = {key.replace('-', '_'): value for key, value in config.items() if key not in COMMANDS}
+
+    # noinspection PyProtectedMember
+    subparsers = next(action for action in parser._actions if isinstance(action, argparse._SubParsersAction))
+    known_anywhere = set()
+    for command, subparser in subparsers.choices.items():
+        options = {key.replace('-', '_'): value for key, value in config.get(command, {}).items()}
+        known = {action.dest for action in subparser._actions}
+        known_anywhere |= known
+        unknown = set(options) - known
+        if unknown:
+            parser.error(f"unknown options in the '{command}' section of {path}: {', '.join(sorted(unknown))}")
+        # a command's own section overrides the top-level options
+        subparser.set_defaults(**{**{key: value for key, value in shared.items() if key in known}, **options})
+
+    unknown = set(shared) - known_anywhere
+    if unknown:
+        parser.error(f"unknown options in {path}: {', '.join(sorted(unknown))}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = build_parser()
+
+    # the config file has to be read before everything else is parsed, since it changes the defaults
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument('--config')
+    config_args, _ = config_parser.parse_known_args(argv)
+    if config_args.config:
+        load_config(parser, config_args.config)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
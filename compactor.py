@@ -0,0 +1,248 @@
+import os
+from datetime import datetime, timedelta
+from itertools import groupby
+from threading import Event, Thread
+from typing import Dict, List, Optional
+
+import cv2
+
+from channel_index import ChannelIndex
+from frame_cache import FRAME_CACHE
+from metrics import METRICS
+from proxies import available_factors, existing_proxy_paths
+from segments import SEGMENT_EXTENSION, segments_dir, write_table
+
+
+def compact_channel(image_dir: str, image_names: List[str], fps: float = 2.0, fourcc: str = 'mp4v',
+                    delete_originals: bool = True) -> Optional[str]:
+    """Transcode a channel's JPEGs into one video segment with a frame-timestamp table
+
+    The segment is only made visible (by writing its table) once every frame has been written
+    and verified, and the original images are only deleted after that. Images that can't be
+    read are left out of the segment and aren't deleted. Proxies of compacted images are deleted
+    along with them.
+
+    Parameters
+    ----------
+    image_dir : str
+        The channel directory the images are in
+    image_names : List[str]
+        The names of the images to compact, in order
+    fps : float, default=2.0
+        The nominal framerate of the segment (the table holds the actual timestamps)
+    fourcc : str, default='mp4v'
+        The codec to compress the segment with
+    delete_originals : bool, default=True
+        Whether to delete the images once they have been compacted
+
+    Returns
+    -------
+    str, optional
+        The path of the new segment or None if it couldn't be created
+    """
+
+    if not image_names:
+        return None
+
+    os.makedirs(segments_dir(image_dir), exist_ok=True)
+    segment_path = os.path.join(segments_dir(image_dir), os.path.splitext(image_names[0])[0] + SEGMENT_EXTENSION)
+    partial_path = os.path.splitext(segment_path)[0] + '.partial' + SEGMENT_EXTENSION
+
+    # frames that can't be read are left out of the segment (and the table) rather than failing it
+    written_names = []
+    video = None
+    for image_name in image_names:
+        frame = cv2.imread(os.path.join(image_dir, image_name))
+        if frame is None:
+            continue
+        if video is None:
+            height, width = frame.shape[:2]
+            video = cv2.VideoWriter(partial_path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+            if not video.isOpened():  # the codec isn't available
+                video.release()
+                METRICS.inc('compaction_failures_total')
+                return None
+        elif frame.shape[:2] != (height, width):
+            # noinspection PyUnboundLocalVariable
+            frame = cv2.resize(frame, (width, height))
+        video.write(frame)
+        written_names.append(image_name)
+    if video is None:
+        return None
+    video.release()
+
+    # make sure every frame actually made it into the segment before trusting it
+    capture = cv2.VideoCapture(partial_path)
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    if frame_count != len(written_names):
+        try:
+            os.remove(partial_path)
+        except FileNotFoundError:
+            pass
+        METRICS.inc('compaction_failures_total')
+        return None
+
+    os.replace(partial_path, segment_path)
+    write_table(segment_path, written_names)
+
+    if delete_originals:
+        factors = available_factors(image_dir)
+        for image_name in written_names:
+            path = os.path.join(image_dir, image_name)
+            for removed_path in existing_proxy_paths(path, factors) + [path]:
+                try:
+                    os.remove(removed_path)
+                except FileNotFoundError:
+                    pass
+                FRAME_CACHE.discard(removed_path)
+
+    METRICS.inc('compaction_segments_written_total')
+    METRICS.inc('compaction_frames_compacted_total', len(written_names))
+    return segment_path
+
+
+def compact_images(image_paths: List[str], fps: float = 2.0, fourcc: str = 'mp4v') -> List[str]:
+    """Compact images from any number of channels into one segment per channel
+
+    This can be passed to RetentionManager as its archive callable.
+
+    Parameters
+    ----------
+    image_paths : List[str]
+        The paths of the images to compact
+    fps : float, default=2.0
+        The nominal framerate of the segments
+    fourcc : str, default='mp4v'
+        The codec to compress the segments with
+
+    Returns
+    -------
+    List[str]
+        The paths of the new segments
+    """
+
+    by_channel: Dict[str, List[str]] = {}
+    for path in sorted(image_paths):
+        by_channel.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
+
+    segment_paths = []
+    for image_dir, image_names in by_channel.items():
+        segment_path = compact_channel(image_dir, image_names, fps, fourcc)
+        if segment_path is None:
+            raise RuntimeError(f'failed to compact {len(image_names)} images in {image_dir}')
+        segment_paths.append(segment_path)
+    return segment_paths
+
+
+class Compactor:
+    """A class that uses threading to compact finished time ranges of JPEGs into video segments
+
+    Attributes
+    ----------
+    image_dirs : List[str]
+        The paths of both the root image directory and the channel directories
+    segment_seconds : int
+        How many seconds of images go into each segment
+    min_age : timedelta
+        How long after a segment's time range ends before it is compacted, so that images
+        still being written (or with a dt_offset) aren't missed
+    check_interval : float
+        How many seconds to wait in between looking for time ranges to compact
+    fps : float
+        The nominal framerate of the segments
+    fourcc : str
+        The codec to compress the segments with
+    verbose : bool
+        Whether to log to the console information about what is being compacted
+    """
+
+    def __init__(self, image_dirs: List[str], segment_seconds: int = 600, min_age: timedelta = timedelta(minutes=5),
+                 check_interval: float = 60.0, fps: float = 2.0, fourcc: str = 'mp4v', verbose: bool = True):
+        """
+        Parameters
+        ----------
+        image_dirs : List[str]
+            The paths of both the root image directory and the channel directories
+        segment_seconds : int, default=600
+            How many seconds of images go into each segment
+        min_age : timedelta, default=timedelta(minutes=5)
+            How long after a segment's time range ends before it is compacted, so that images
+            still being written (or with a dt_offset) aren't missed
+        check_interval : float, default=60.0
+            How many seconds to wait in between looking for time ranges to compact
+        fps : float, default=2.0
+            The nominal framerate of the segments
+        fourcc : str, default='mp4v'
+            The codec to compress the segments with
+        verbose : bool, default=True
+            Whether to log to the console information about what is being compacted
+        """
+
+        self.image_dirs = image_dirs
+        self.segment_seconds = segment_seconds
+        self.min_age = min_age
+        self.check_interval = check_interval
+        self.fps = fps
+        self.fourcc = fourcc
+        self.verbose = verbose
+
+        self._thread: Optional[Thread] = None
+        self._stop_event = Event()
+
+    def run_once(self) -> int:
+        """Compact every finished time range that still has loose JPEGs
+
+        Returns
+        -------
+        int
+            How many segments were written
+        """
+
+        cutoff = datetime.now() - self.min_age
+        written = 0
+        for image_dir in self.image_dirs[1:]:
+            index = ChannelIndex.load(image_dir)
+            loose = [(name, timestamp) for name, timestamp, source in zip(index.names, index.timestamps, index.sources)
+                     if isinstance(source, str)]
+
+            def window_of(item) -> int:
+                return int(item[1].item().timestamp() // self.segment_seconds)
+
+            for window, items in groupby(loose, key=window_of):
+                window_end = datetime.fromtimestamp((window + 1) * self.segment_seconds)
+                if self._stop_event.is_set() or window_end > cutoff:
+                    break
+                image_names = [name for name, _ in items]
+                segment_path = compact_channel(image_dir, image_names, self.fps, self.fourcc)
+                if segment_path is not None:
+                    written += 1
+                    if self.verbose:
+                        print(f'Compacted {len(image_names)} images into {segment_path}')
+                elif self.verbose:
+                    print(f'Failed to compact {len(image_names)} images starting at {image_names[0]}')
+        return written
+
+    def start(self):
+        """Start compacting in the background"""
+
+        def compact():
+            while True:
+                try:
+                    self.run_once()
+                except OSError as e:  # keep going, the disk may just be busy
+                    print(f'Compaction failed: {e!r}')
+                if self._stop_event.wait(self.check_interval):
+                    break
+
+        self._stop_event.clear()
+        self._thread = Thread(target=compact, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop compacting, finishing the segment being written first"""
+
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()  # wait for thread to finish
+            self._thread = None
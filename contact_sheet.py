@@ -0,0 +1,114 @@
+import concurrent.futures
+import os
+from typing import List, Optional
+
+import cv2
+import numpy
+
+from channel_index import ChannelIndex
+from image_collection import ImageCollection, NUM_CAMERAS
+from metrics import METRICS
+from timeline import plan_timeline
+
+# how many pixels separate the grids on a page
+GRID_SPACING = 8
+
+
+def _label(grid: numpy.ndarray, text: str):
+    """Write a slot's time into the empty ninth cell of an ImageCollection grid"""
+
+    h, w = grid.shape[0] // 3, grid.shape[1] // 3
+    scale = w / 400
+    (text_w, text_h), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, 1)
+    origin = (2 * w + (w - text_w) // 2, 2 * h + (h + text_h) // 2)
+    cv2.putText(grid, text, origin, cv2.FONT_HERSHEY_SIMPLEX, scale, (255, 255, 255), max(1, round(scale)),
+                cv2.LINE_AA)
+
+
+def contact_sheets(images_dir: Optional[str] = None, output_dir: Optional[str] = None, interval_minutes: float = 10,
+                   shrink_factor: int = 8, columns: int = 4, rows: int = 6,
+                   max_workers: Optional[int] = None) -> List[str]:
+    """Creates paged contact sheets that give an overview of a whole recording session
+
+    Every N minutes of the session becomes one ImageCollection grid (one tile per channel, with
+    the time in the empty ninth cell), and the grids are laid out columns x rows to a page. Tiles
+    are read at the smallest size available: the Recorder's proxies if they exist, otherwise
+    JPEGs are shrunk by libjpeg while they are decoded, and the grids are built in a thread pool.
+    Time ranges where no channel has an image are left out.
+
+    Parameters
+    ----------
+    images_dir : str, optional
+        The root directory of all the images
+    output_dir : str, optional
+        The directory to save the contact sheets (contact_sheet_01.jpg, ...) in
+    interval_minutes : float, default=10
+        How many minutes apart the grids are
+    shrink_factor : int, default=8
+        Shrink the tiles by this factor (2, 4 and 8 are decoded the fastest)
+    columns : int, default=4
+        How many grids are next to each other on a page
+    rows : int, default=6
+        How many grids are on top of each other on a page
+    max_workers : int, optional
+        How many threads build grids, default is one per CPU
+
+    Returns
+    -------
+    List[str]
+        The paths of the created contact sheets
+    """
+
+    images_dir = images_dir or 'images'
+    output_dir = output_dir or '.'
+    image_dirs = [os.path.join(images_dir, f'ch{i + 1}') for i in range(NUM_CAMERAS)]
+    indexes = [ChannelIndex.load(image_dir) if os.path.isdir(image_dir) else None for image_dir in image_dirs]
+    indexes_with_images = [index for index in indexes if index is not None and len(index)]
+    if not indexes_with_images:
+        return []
+
+    # every channel shows its image closest to each slot's time, as long as it's within the slot
+    start = min(index.timestamps[0] for index in indexes_with_images)
+    end = max(index.timestamps[-1] for index in indexes_with_images)
+    interval_seconds = interval_minutes * 60
+    plans = [plan_timeline(index.timestamps if index is not None else [], 1 / interval_seconds, start, end,
+                           interval_seconds / 2) for index in indexes]
+    slot_times = plans[0].slot_times
+    frame_indices = numpy.stack([plan.frame_indices for plan in plans], axis=1)
+    slots = [slot for slot in range(len(slot_times)) if numpy.any(frame_indices[slot] >= 0)]
+
+    # for use in the thread pool
+    def create_image_grid(slot: int) -> numpy.ndarray:
+        image_paths = [index[i] if i >= 0 else None for index, i in zip(indexes, frame_indices[slot])]
+        with METRICS.time('contact_sheet_stage_seconds', stage='grid'):
+            grid = ImageCollection(image_paths).to_cv2_image_grid(shrink_factor)
+        _label(grid, str(slot_times[slot].astype('datetime64[m]')).replace('T', ' '))
+        return grid
+
+    os.makedirs(output_dir, exist_ok=True)
+    per_page = columns * rows
+    sheet_paths = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        grids = executor.map(create_image_grid, slots)
+        page = None
+        for i, grid in enumerate(grids):
+            position = i % per_page
+            if position == 0:
+                # every grid takes on the size of the first one
+                h, w = grid.shape[:2]
+                page_rows = min(rows, -(-(len(slots) - i) // columns))
+                page = numpy.zeros((page_rows * (h + GRID_SPACING) - GRID_SPACING,
+                                    columns * (w + GRID_SPACING) - GRID_SPACING, 3), dtype=numpy.uint8)
+            elif grid.shape[:2] != (h, w):
+                # noinspection PyUnboundLocalVariable
+                grid = cv2.resize(grid, (w, h), interpolation=cv2.INTER_AREA)
+            top = position // columns * (h + GRID_SPACING)
+            left = position % columns * (w + GRID_SPACING)
+            page[top:top + h, left:left + w] = grid
+
+            if position == per_page - 1 or i == len(slots) - 1:
+                sheet_path = os.path.join(output_dir, f'contact_sheet_{len(sheet_paths) + 1:02d}.jpg')
+                cv2.imwrite(sheet_path, page)
+                sheet_paths.append(sheet_path)
+
+    return sheet_paths
@@ -0,0 +1,122 @@
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+from typing import Deque, Optional
+
+import cv2
+import numpy
+
+from metrics import METRICS
+
+
+class Cv2Client:
+    """A drop-in replacement for rtsp.Client that hands out frames as BGR numpy arrays
+
+    rtsp.Client converts every frame to a PIL Image, which then has to be converted back for
+    anything cv2-based. This client keeps the contiguous BGR arrays that cv2.VideoCapture
+    decodes into, so the Recorder can encode them with cv2.imencode without any colour-space
+    conversions or copies. A background thread keeps reading the stream so read() always
+    returns the most recent frame instead of one that has been sitting in the buffer.
+
+    When the stream drops, the capture is reopened after max_failures reads in a row fail, and
+    read() returns None instead of the last frame once that is older than max_frame_age seconds,
+    so a dead stream shows up as dropped frames rather than as the same image over and over.
+
+    Attributes
+    ----------
+    url : str
+        The URL (or device index / file path) of the stream
+    verbose : bool
+        Whether to log to the console when connecting and disconnecting
+    max_failures : int
+        How many reads in a row may fail before the stream is reopened
+    max_frame_age : float
+        How many seconds old the most recent frame may be before read() stops returning it
+    """
+
+    def __init__(self, url: str, verbose: bool = False, buffer_size: int = 1, max_failures: int = 20,
+                 max_frame_age: float = 2.0):
+        """
+        Parameters
+        ----------
+        url : str
+            The URL (or device index / file path) of the stream
+        verbose : bool, default=False
+            Whether to log to the console when connecting and disconnecting
+        buffer_size : int, default=1
+            How many of the most recent frames to keep in the ring buffer
+        max_failures : int, default=20
+            How many reads in a row may fail (0.1 seconds apart) before the stream is reopened
+        max_frame_age : float, default=2.0
+            How many seconds old the most recent frame may be before read() stops returning it
+        """
+
+        self.url = url
+        self.verbose = verbose
+        self.max_failures = max_failures
+        self.max_frame_age = max_frame_age
+        self._capture = self._open()
+        self._frames: Deque[numpy.ndarray] = deque(maxlen=buffer_size)
+        self._last_frame_time = float('-inf')
+        self._lock = Lock()
+        self._stop_event = Event()
+        self._thread = Thread(target=self._read_continuously, daemon=True)
+        self._thread.start()
+        if self.verbose:
+            print(f'Connected to {url}')
+
+    def _open(self) -> cv2.VideoCapture:
+        capture = cv2.VideoCapture(self.url)
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # don't let stale frames queue up in the backend
+        return capture
+
+    def _read_continuously(self):
+        failures = 0
+        while not self._stop_event.is_set():
+            success, frame = self._capture.read()
+            if not success:
+                failures += 1
+                if failures >= self.max_failures:
+                    # the stream dropped and isn't coming back on its own, so reconnect
+                    if self.verbose:
+                        print(f'Lost {self.url}, reconnecting')
+                    METRICS.inc('camera_reconnects_total')
+                    self._capture.release()
+                    self._capture = self._open()
+                    failures = 0
+                self._stop_event.wait(0.1)  # the stream dropped, give it a moment
+                continue
+            failures = 0
+            with self._lock:
+                self._frames.append(frame)
+                self._last_frame_time = time.monotonic()
+
+    def read(self) -> Optional[numpy.ndarray]:
+        """Get the most recent frame
+
+        Returns
+        -------
+        numpy.ndarray, optional
+            The most recent BGR frame or None if no frame has been received in the last
+            max_frame_age seconds
+        """
+
+        with self._lock:
+            if not self._frames or time.monotonic() - self._last_frame_time > self.max_frame_age:
+                return None
+            return self._frames[-1]
+
+    def recent_frames(self):
+        """Get every frame in the ring buffer, oldest first"""
+
+        with self._lock:
+            return list(self._frames)
+
+    def close(self):
+        """Stop reading and disconnect from the stream"""
+
+        self._stop_event.set()
+        self._thread.join()
+        self._capture.release()
+        if self.verbose:
+            print(f'Disconnected from {self.url}')
@@ -0,0 +1,192 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Tuple, Union
+
+import cv2
+import numpy
+
+from metrics import METRICS
+from segments import SegmentFrame, read_frame
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024  # 512 MiB
+
+# shrink factors that libjpeg can apply while decoding, which is much cheaper than resizing afterwards
+_REDUCED_READ_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+class FrameCache:
+    """A thread-safe, size-bounded LRU cache of decoded (and optionally pre-shrunk) images
+
+    Entries are keyed by the image's path (or segment frame), its file's modification time and the
+    shrink factor it was decoded with, so an image that is rewritten on the disk is never served
+    stale. The cached arrays are marked read-only because they are shared between every caller.
+
+    Attributes
+    ----------
+    max_bytes : int
+        The maximum number of bytes of decoded image data to keep (0 disables the cache)
+    hits : int
+        How many lookups were served from the cache
+    misses : int
+        How many lookups had to decode the image from the disk
+    evictions : int
+        How many entries were dropped to stay under max_bytes
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Parameters
+        ----------
+        max_bytes : int, default=DEFAULT_MAX_BYTES
+            The maximum number of bytes of decoded image data to keep (0 disables the cache)
+        """
+
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: 'OrderedDict[Tuple[Union[str, SegmentFrame], int, int], numpy.ndarray]' = OrderedDict()
+        self._current_bytes = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def decode(source: Union[str, SegmentFrame], shrink_factor: int = 1) -> Optional[numpy.ndarray]:
+        """Decode an image from the disk, shrinking it by shrink_factor
+
+        Parameters
+        ----------
+        source : Union[str, SegmentFrame]
+            The path of the image or the segment frame to decode
+        shrink_factor : int, default=1
+            Shrink the image by this factor, default is no change
+
+        Returns
+        -------
+        numpy.ndarray, optional
+            The decoded cv2-compatible image or None if it couldn't be read
+        """
+
+        if isinstance(source, SegmentFrame):
+            with METRICS.time('frame_stage_seconds', stage='decode_segment'):
+                image = read_frame(source)
+        elif shrink_factor in _REDUCED_READ_FLAGS:
+            with METRICS.time('frame_stage_seconds', stage='decode_reduced'):
+                return cv2.imread(source, _REDUCED_READ_FLAGS[shrink_factor])
+        else:
+            with METRICS.time('frame_stage_seconds', stage='decode'):
+                image = cv2.imread(source)
+
+        if image is not None and shrink_factor > 1:
+            h, w = image.shape[:2]
+            with METRICS.time('frame_stage_seconds', stage='resize'):
+                image = cv2.resize(image, (w // shrink_factor, h // shrink_factor), interpolation=cv2.INTER_AREA)
+        return image
+
+    def get(self, source: Union[str, SegmentFrame], shrink_factor: int = 1) -> Optional[numpy.ndarray]:
+        """Get a decoded image, reading it from the disk only if it isn't already cached
+
+        Parameters
+        ----------
+        source : Union[str, SegmentFrame]
+            The path of the image or the segment frame to get
+        shrink_factor : int, default=1
+            Shrink the image by this factor, default is no change
+
+        Returns
+        -------
+        numpy.ndarray, optional
+            The read-only cv2-compatible image or None if it couldn't be read
+        """
+
+        path = source.segment_path if isinstance(source, SegmentFrame) else source
+        try:
+            key = (source, os.stat(path).st_mtime_ns, shrink_factor)
+        except OSError:  # image was deleted or never existed
+            return None
+
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                METRICS.inc('frame_cache_hits_total')
+                return image
+            self.misses += 1
+        METRICS.inc('frame_cache_misses_total')
+
+        # decode outside the lock so other threads aren't blocked by slow reads
+        image = self.decode(source, shrink_factor)
+        if image is not None:
+            image.flags.writeable = False
+            self._put(key, image)
+        return image
+
+    def _put(self, key: Tuple[Union[str, SegmentFrame], int, int], image: numpy.ndarray):
+        """Insert an image into the cache, evicting the least recently used entries if necessary"""
+
+        if image.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = image
+            self._current_bytes += image.nbytes
+            while self._current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._current_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def discard(self, path: str):
+        """Drop every cached version of an image (or every frame of a segment), e.g. after it has been deleted
+
+        Parameters
+        ----------
+        path : str
+            The path of the image or segment to drop
+        """
+
+        def matches(source: Union[str, SegmentFrame]) -> bool:
+            return source.segment_path == path if isinstance(source, SegmentFrame) else source == path
+
+        with self._lock:
+            for key in [key for key in self._entries if matches(key[0])]:
+                self._current_bytes -= self._entries.pop(key).nbytes
+
+    def clear(self):
+        """Drop every entry and reset the statistics"""
+
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, float]:
+        """Get the cache's hit/miss statistics
+
+        Returns
+        -------
+        Dict[str, float]
+            The hits, misses, evictions, hit_rate, entries, bytes and max_bytes of the cache
+        """
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._current_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+# the cache shared by every ImageCollection in this process
+FRAME_CACHE = FrameCache()
@@ -0,0 +1,259 @@
+import concurrent.futures
+import os
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy
+from numpy.lib.format import open_memmap
+
+from channel_index import ChannelIndex, FrameSource, nearest_index
+from frame_cache import FrameCache
+from image_collection import NUM_CAMERAS
+from metrics import METRICS
+from segments import SegmentFrame, read_frames, split_runs
+
+# a channel's frames are kept in <store dir>/ch<channel>.npy with their timestamps in ch<channel>.timestamps.npy
+STORE_DIR_NAME = 'frame_store'
+FRAMES_EXTENSION = '.npy'
+TIMESTAMPS_EXTENSION = '.timestamps.npy'
+
+
+def store_paths(store_dir: str, channel: int) -> Tuple[str, str]:
+    """Get the paths of a channel's frames and timestamps in a frame store"""
+
+    return os.path.join(store_dir, f'ch{channel}{FRAMES_EXTENSION}'), \
+        os.path.join(store_dir, f'ch{channel}{TIMESTAMPS_EXTENSION}')
+
+
+def _decode_run(sources: List[FrameSource], shrink_factor: int) -> List[Optional[numpy.ndarray]]:
+    """Decode consecutive frames, reading runs of frames from the same segment sequentially"""
+
+    images = []
+    for run in split_runs(sources):
+        if isinstance(run[0], SegmentFrame):
+            for frame in read_frames(run[0].segment_path, run[0].frame_number, len(run)):
+                if frame is not None and shrink_factor > 1:
+                    h, w = frame.shape[:2]
+                    frame = cv2.resize(frame, (w // shrink_factor, h // shrink_factor), interpolation=cv2.INTER_AREA)
+                images.append(frame)
+        else:
+            images.extend(FrameCache.decode(source, shrink_factor) for source in run)
+    return images
+
+
+def export_channel(index: ChannelIndex, frames_path: str, timestamps_path: str, shrink_factor: int = 1,
+                   max_workers: Optional[int] = None, chunk_size: int = 64) -> bool:
+    """Decode every frame of a channel into a memory-mapped .npy array
+
+    The frames are written to a partial file that is only renamed into place once every frame
+    has been written, and the timestamps file is written last, which marks the export as
+    complete. Frames that can't be read are left black. A channel whose export already matches
+    its index (same timestamps and frame size) isn't exported again.
+
+    Parameters
+    ----------
+    index : ChannelIndex
+        The channel to export
+    frames_path : str
+        The path of the .npy file to write the frames to, with shape (frames, height, width, 3)
+    timestamps_path : str
+        The path of the .npy file to write the frames' datetime64[us] timestamps to
+    shrink_factor : int, default=1
+        Shrink the frames by this factor, default is no change
+    max_workers : int, optional
+        How many threads decode frames, default is one per CPU
+    chunk_size : int, default=64
+        How many frames each decode task handles
+
+    Returns
+    -------
+    bool
+        Whether the channel was exported (False if it was already up to date or has no frames)
+    """
+
+    if len(index) == 0:
+        return False
+    first_frame = _decode_run(index.sources[:1], shrink_factor)[0]
+    if first_frame is None:
+        raise ValueError(f'Unable to read the first frame of {index.image_dir}')
+    shape = (len(index),) + first_frame.shape
+
+    # skip the export if the existing one is already up to date
+    try:
+        up_to_date = numpy.load(frames_path, mmap_mode='r').shape == shape and \
+            numpy.array_equal(numpy.load(timestamps_path), index.timestamps)
+    except (FileNotFoundError, ValueError):
+        up_to_date = False
+    if up_to_date:
+        return False
+
+    os.makedirs(os.path.dirname(frames_path) or '.', exist_ok=True)
+    partial_path = os.path.splitext(frames_path)[0] + '.partial' + FRAMES_EXTENSION
+    frames = open_memmap(partial_path, mode='w+', dtype=numpy.uint8, shape=shape)
+    height, width = first_frame.shape[:2]
+
+    # every task writes its own slice of the memmap
+    def export_chunk(start: int):
+        with METRICS.time('frame_store_stage_seconds', stage='decode_chunk'):
+            images = _decode_run(index.sources[start:start + chunk_size], shrink_factor)
+        for i, image in enumerate(images, start):
+            if image is None:  # unreadable frame, left black
+                METRICS.inc('frame_store_frames_unreadable_total')
+                continue
+            if image.shape[:2] != (height, width):
+                image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+            frames[i] = image
+        METRICS.inc('frame_store_frames_written_total', len(images))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(export_chunk, range(0, len(index), chunk_size)):
+                pass
+        frames.flush()
+    finally:
+        del frames  # close the memmap so the file can be renamed (or deleted) on Windows
+
+    if os.path.exists(timestamps_path):
+        os.remove(timestamps_path)  # the export is incomplete until the new timestamps are written
+    os.replace(partial_path, frames_path)
+    numpy.save(f'{timestamps_path}.tmp.npy', index.timestamps)
+    os.replace(f'{timestamps_path}.tmp.npy', timestamps_path)
+    return True
+
+
+def export_frame_store(images_dir: Optional[str] = None, store_dir: Optional[str] = None, shrink_factor: int = 1,
+                       channels: Optional[List[int]] = None, max_workers: Optional[int] = None) -> List[str]:
+    """Export every channel's frames (optionally shrunk) into memory-mapped .npy arrays
+
+    After the export, FrameStore gives analysis scripts random access to any frame without
+    decoding a single JPEG. Channels that are already up to date are skipped, so this can be
+    called before every analysis pass.
+
+    Parameters
+    ----------
+    images_dir : str, optional
+        The root directory of all the images
+    store_dir : str, optional
+        The directory to export to, default is the STORE_DIR_NAME directory inside images_dir
+    shrink_factor : int, default=1
+        Shrink the frames by this factor, default is no change
+    channels : List[int], optional
+        The channels to export, default is every channel
+    max_workers : int, optional
+        How many threads decode frames, default is one per CPU
+
+    Returns
+    -------
+    List[str]
+        The paths of the frame files of every channel that has frames
+    """
+
+    images_dir = images_dir or 'images'
+    store_dir = store_dir or os.path.join(images_dir, STORE_DIR_NAME)
+    channels = channels or [i + 1 for i in range(NUM_CAMERAS)]
+
+    frames_paths = []
+    for channel in channels:
+        image_dir = os.path.join(images_dir, f'ch{channel}')
+        if not os.path.isdir(image_dir):
+            continue
+        index = ChannelIndex.load(image_dir)
+        if len(index) == 0:
+            continue
+        frames_path, timestamps_path = store_paths(store_dir, channel)
+        export_channel(index, frames_path, timestamps_path, shrink_factor, max_workers)
+        frames_paths.append(frames_path)
+    return frames_paths
+
+
+class FrameStore:
+    """Read-only, zero-copy access to a channel's frames in a frame store
+
+    The frames are memory-mapped, so opening a store is instant no matter how large it is, only
+    the frames that are actually accessed are read from the disk, and the OS page cache keeps
+    them around between analysis passes. Every frame is a cv2-compatible (BGR) ndarray view.
+
+    Attributes
+    ----------
+    frames : numpy.ndarray
+        The read-only memory-mapped frames, with shape (frames, height, width, 3)
+    timestamps : numpy.ndarray
+        The timestamp of every frame as datetime64[us], in increasing order
+    """
+
+    def __init__(self, frames_path: str, timestamps_path: str):
+        """
+        Parameters
+        ----------
+        frames_path : str
+            The path of the channel's frames
+        timestamps_path : str
+            The path of the channel's timestamps
+        """
+
+        self.timestamps = numpy.load(timestamps_path)
+        self.frames = numpy.load(frames_path, mmap_mode='r')
+
+    @classmethod
+    def open(cls, channel: int, store_dir: Optional[str] = None) -> 'FrameStore':
+        """Open a channel's frames that were exported with export_frame_store()
+
+        Parameters
+        ----------
+        channel : int
+            The channel to open
+        store_dir : str, optional
+            The directory the frames were exported to, default is the STORE_DIR_NAME directory
+            inside the 'images' directory
+
+        Returns
+        -------
+        FrameStore
+        """
+
+        return cls(*store_paths(store_dir or os.path.join('images', STORE_DIR_NAME), channel))
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def __getitem__(self, item) -> numpy.ndarray:
+        return self.frames[item]
+
+    def nearest(self, timestamp: datetime, max_seconds_apart: float = 1) -> Optional[int]:
+        """Get the position of the frame closest to a timestamp
+
+        Parameters
+        ----------
+        timestamp : datetime
+            The target timestamp
+        max_seconds_apart : float, default=1
+            Ignore frames with timestamps too many seconds away from the target,
+            even if it's the closest one
+
+        Returns
+        -------
+        int, optional
+            The position of the closest frame or None if there isn't one close enough
+        """
+
+        return nearest_index(self.timestamps, timestamp, max_seconds_apart)
+
+    def between(self, start: datetime, end: datetime) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """Get the frames (and their timestamps) recorded between two timestamps, without copying them
+
+        Parameters
+        ----------
+        start : datetime
+            The earliest timestamp (inclusive)
+        end : datetime
+            The latest timestamp (exclusive)
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray]
+            A view of the frames and of their timestamps
+        """
+
+        first, last = numpy.searchsorted(self.timestamps, [numpy.datetime64(start, 'us'), numpy.datetime64(end, 'us')])
+        return self.frames[first:last], self.timestamps[first:last]
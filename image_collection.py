@@ -1,13 +1,18 @@
 import os
-from datetime import datetime, timedelta
-from typing import List, Iterable, Optional
+from datetime import datetime
+from typing import List, Iterable, Optional, Tuple
 
 import cv2
 import numpy
 from PIL import Image, ImageDraw, ImageFont
 
+from channel_index import ChannelIndex, FrameSource
+from frame_cache import FRAME_CACHE
+from proxies import best_proxy
+from segments import SegmentFrame
+
 NUM_CAMERAS = 8
-PIC_DIRS = ['images'] + [f'images\\ch{i + 1}' for i in range(NUM_CAMERAS)]
+PIC_DIRS = ['images'] + [os.path.join('images', f'ch{i + 1}') for i in range(NUM_CAMERAS)]
 
 
 class ImageCollection:
@@ -15,16 +20,18 @@ class ImageCollection:
 
     Attributes
     ----------
-    image_paths : List[Optional[str]]
-        A list of paths to a single image, one from each channel, or None if one doesn't exist
+    image_paths : List[Optional[FrameSource]]
+        A list of paths to a single image (or a frame in a compacted segment), one from each channel,
+        or None if one doesn't exist
     """
 
-    def __init__(self, image_paths: List[Optional[str]]):
+    def __init__(self, image_paths: List[Optional[FrameSource]]):
         """
         Parameters
         ----------
-        image_paths : List[Optional[str]]
-            A list of paths to a single image, one from each channel, or None if one doesn't exist
+        image_paths : List[Optional[FrameSource]]
+            A list of paths to a single image (or a frame in a compacted segment), one from each channel,
+            or None if one doesn't exist
         """
         if len(image_paths) != NUM_CAMERAS:
             raise ValueError(f'images_paths parameter must contain {NUM_CAMERAS} image paths')
@@ -72,6 +79,34 @@ class ImageCollection:
         pil_image = Image.fromarray(color_converted)
         return pil_image
 
+    @staticmethod
+    def _create_filler_image(channel_index: int, w: int, h: int) -> Image.Image:
+        """Create a filler image with "CH_ is unavailable" in the middle"""
+
+        filler_image = Image.new('RGB', (w, h))
+        filler_text = ImageDraw.Draw(filler_image)
+        text = f'CH{channel_index + 1} is unavailable'
+        try:
+            filler_font = ImageFont.truetype('arial', max(1, w // 20))
+        except OSError:  # arial isn't installed (e.g. on Linux)
+            try:
+                filler_font = ImageFont.load_default(max(1, w // 20))
+            except TypeError:  # Pillow < 10.1 only has a fixed-size default font
+                filler_font = ImageFont.load_default()
+        # center the text by its bounding box, which (unlike anchors) works with every kind of font
+        left, top, right, bottom = filler_text.textbbox((0, 0), text, font=filler_font)
+        filler_text.text(((w - right - left) / 2, (h - bottom - top) / 2), text, font=filler_font)
+        return filler_image
+
+    @staticmethod
+    def _image_size(image_path: FrameSource) -> Tuple[int, int]:
+        """Get the (width, height) of an image, only reading the header of loose JPEGs"""
+
+        if isinstance(image_path, SegmentFrame):
+            h, w = FRAME_CACHE.get(image_path).shape[:2]
+            return w, h
+        return Image.open(image_path).size
+
     def to_pil_images(self, create_filler_images: bool = True) -> List[Image.Image]:
         """Converts this object's image_paths to a list of PIL Images
 
@@ -89,19 +124,17 @@ class ImageCollection:
 
         # get height and width from an actual image
         if create_filler_images:
-            w, h = Image.open(next(filter(lambda x: x is not None, self.image_paths))).size
+            w, h = self._image_size(next(filter(lambda x: x is not None, self.image_paths)))
 
         resulting_images = []
         for i, image_path in enumerate(self.image_paths):
-            if image_path:
+            if isinstance(image_path, SegmentFrame):
+                resulting_images.append(self.cv2_to_pil(FRAME_CACHE.get(image_path)))
+            elif image_path:
                 resulting_images.append(Image.open(image_path))
             elif create_filler_images:  # create filler image with channel number in the middle
                 # noinspection PyUnboundLocalVariable
-                filler_image = Image.new('RGB', (w, h))
-                filler_text = ImageDraw.Draw(filler_image)
-                filler_font = ImageFont.truetype('arial', w // 20)
-                filler_text.text((w / 2, h / 2), f'CH{i + 1} is unavailable', font=filler_font, anchor='mm')
-                resulting_images.append(filler_image)
+                resulting_images.append(self._create_filler_image(i, w, h))
             else:
                 resulting_images.append(None)
 
@@ -124,58 +157,78 @@ class ImageCollection:
 
         # get height and width from an actual image
         if create_filler_images:
-            w, h = Image.open(next(filter(lambda x: x is not None, self.image_paths))).size
+            w, h = self._image_size(next(filter(lambda x: x is not None, self.image_paths)))
 
         resulting_images = []
         for i, image_path in enumerate(self.image_paths):
             if image_path:
-                resulting_images.append(cv2.imread(image_path))
+                # copy the shared cached image so the caller is free to modify it
+                image = FRAME_CACHE.get(image_path)
+                resulting_images.append(image.copy() if image is not None else None)
             elif create_filler_images:  # create filler image with channel number in the middle
                 # noinspection PyUnboundLocalVariable
-                filler_image = Image.new('RGB', (w, h))
-                filler_text = ImageDraw.Draw(filler_image)
-                filler_font = ImageFont.truetype('arial', w // 20)
-                filler_text.text((w / 2, h / 2), f'CH{i + 1} is unavailable', font=filler_font, anchor='mm')
-                resulting_images.append(self.pil_to_cv2(filler_image))
+                resulting_images.append(self.pil_to_cv2(self._create_filler_image(i, w, h)))
             else:
                 resulting_images.append(None)
 
         return resulting_images
 
-    def to_pil_image_grid(self, shrink_factor: int = 1) -> Image.Image:
-        """Create a 3x3 grid of all the images in image_paths
+    def to_cv2_tiles(self, shrink_factor: int = 1) -> List[numpy.ndarray]:
+        """Get every channel's image shrunk to the same size, ready to be placed in a grid
+
+        The images come from the process-wide FRAME_CACHE, so they are only decoded once no
+        matter how many grids they appear in. The returned arrays are shared and read-only.
+        If the Recorder wrote proxies, the smallest proxy that can be shrunk to the requested
+        size is read instead of the original image.
 
         Parameters
         ----------
         shrink_factor : int, default=1
-            Shrink the images in the grid by this factor, default is no change
+            Shrink the images by this factor, default is no change
 
         Returns
         -------
-        Image.Image
-            The resulting PIL Image object of the grid
+        List[numpy.ndarray]
+            The resulting cv2-compatible images, with filler images for missing channels
         """
 
-        # define the grid
-        cols = 3
-        rows = 3
+        tiles = []
+        for image_path in self.image_paths:
+            if isinstance(image_path, str):
+                tiles.append(FRAME_CACHE.get(*best_proxy(image_path, shrink_factor)))
+            elif image_path:
+                tiles.append(FRAME_CACHE.get(image_path, shrink_factor))
+            else:
+                tiles.append(None)
 
-        # create Image objects from their image paths
-        images = self.to_pil_images()
+        # every tile takes on the size of the first available image
+        h, w = next(filter(lambda x: x is not None, tiles)).shape[:2]
 
-        # shrink the images according to the shrink_factor parameter
-        w = images[0].size[0] // shrink_factor
-        h = images[0].size[1] // shrink_factor
-        images = [image.resize((w, h)) for image in images]
+        resulting_tiles = []
+        for i, tile in enumerate(tiles):
+            if tile is None:
+                resulting_tiles.append(self.pil_to_cv2(self._create_filler_image(i, w, h)))
+            elif tile.shape[:2] != (h, w):
+                resulting_tiles.append(cv2.resize(tile, (w, h), interpolation=cv2.INTER_AREA))
+            else:
+                resulting_tiles.append(tile)
+        return resulting_tiles
 
-        # create base grid image
-        grid = Image.new('RGB', size=(cols * w, rows * h))
+    def to_pil_image_grid(self, shrink_factor: int = 1) -> Image.Image:
+        """Create a 3x3 grid of all the images in image_paths
 
-        # fill in grid with actual images
-        for i, image in enumerate(images):
-            grid.paste(image, box=(i % cols * w, i // cols * h))
+        Parameters
+        ----------
+        shrink_factor : int, default=1
+            Shrink the images in the grid by this factor, default is no change
 
-        return grid
+        Returns
+        -------
+        Image.Image
+            The resulting PIL Image object of the grid
+        """
+
+        return self.cv2_to_pil(self.to_cv2_image_grid(shrink_factor))
 
     def to_cv2_image_grid(self, shrink_factor: int = 1) -> numpy.ndarray:
         """Create a 3x3 grid of all the images in image_paths
@@ -191,7 +244,20 @@ class ImageCollection:
             The resulting cv2-compatible image of the grid
         """
 
-        return self.pil_to_cv2(self.to_pil_image_grid(shrink_factor))
+        # define the grid
+        cols = 3
+        rows = 3
+
+        # get the (cached) images, already shrunk according to the shrink_factor parameter
+        tiles = self.to_cv2_tiles(shrink_factor)
+        h, w = tiles[0].shape[:2]
+
+        # create base grid image and fill it in with the actual images
+        grid = numpy.zeros((rows * h, cols * w, 3), dtype=numpy.uint8)
+        for i, tile in enumerate(tiles):
+            grid[i // cols * h:(i // cols + 1) * h, i % cols * w:(i % cols + 1) * w] = tile
+
+        return grid
 
     @staticmethod
     def datetime_from_image_name(image_name: str) -> datetime:
@@ -232,14 +298,14 @@ class ImageCollection:
         return min(possibilities, key=lambda x: abs(x - to))
 
     @classmethod
-    def from_timestamp(cls, timestamp: datetime, max_seconds_apart: int = 1):
+    def from_timestamp(cls, timestamp: datetime, max_seconds_apart: float = 1):
         """Get an image from each channel that is closest to the input timestamp
 
         Parameters
         ----------
         timestamp : datetime
             The target timestamp
-        max_seconds_apart : int, default=1
+        max_seconds_apart : float, default=1
             Ignore images with timestamps too many seconds away from the target,
             even if it's the closest one
 
@@ -250,14 +316,7 @@ class ImageCollection:
 
         resulting_image_paths = []
         for image_dir in PIC_DIRS[1:]:
-            possibilities = {cls.datetime_from_image_name(image_name): image_name for image_name in
-                             os.listdir(image_dir)}
-            if len(possibilities) > 0:
-                closest = cls.closest_datetime(timestamp, possibilities.keys())
-                if abs(timestamp - closest) <= timedelta(seconds=max_seconds_apart):
-                    resulting_image_paths.append(os.path.join(image_dir, possibilities[closest]))
-            else:
-                resulting_image_paths.append(None)
+            resulting_image_paths.append(ChannelIndex.load(image_dir).nearest(timestamp, max_seconds_apart))
         return cls(resulting_image_paths)
 
     @classmethod
@@ -276,11 +335,8 @@ class ImageCollection:
 
         resulting_image_paths = []
         for image_dir in PIC_DIRS[1:]:
-            if len(os.listdir(image_dir)) != 0:
-                try:
-                    resulting_image_paths.append(os.path.join(image_dir, os.listdir(image_dir)[index]))
-                except IndexError:  # index doesn't exist
-                    resulting_image_paths.append(None)
-            else:  # image_dir is empty
+            try:
+                resulting_image_paths.append(ChannelIndex.load(image_dir)[index])
+            except IndexError:  # index doesn't exist or image_dir is empty
                 resulting_image_paths.append(None)
         return cls(resulting_image_paths)
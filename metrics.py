@@ -0,0 +1,417 @@
+import json
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from threading import Event, Lock, Thread
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# upper bounds (in seconds) of the latency histogram buckets, the last bucket is +Inf
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, Any]) -> _Key:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Histogram:
+    """A fixed-bucket histogram of observed values (usually latencies in seconds)
+
+    Attributes
+    ----------
+    buckets : Sequence[float]
+        The upper bounds of each bucket, in increasing order
+    counts : List[int]
+        How many observations fell into each bucket, plus one final +Inf bucket
+    count : int
+        The total number of observations
+    sum : float
+        The sum of every observation
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class _NullTimer:
+    """The timer handed out while metrics are disabled, it does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    """Times the body of a with statement and records it in a histogram"""
+
+    __slots__ = ('_metrics', '_key', '_start')
+
+    def __init__(self, metrics: 'Metrics', key: _Key):
+        self._metrics = metrics
+        self._key = key
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._metrics._observe(self._key, time.perf_counter() - self._start)
+        return False
+
+
+class Metrics:
+    """A thread-safe registry of counters, gauges and latency histograms
+
+    Every metric has a name and optional labels (e.g. channel=3). While the registry is disabled,
+    which is the default, every method returns immediately so instrumented hot paths only pay
+    for a function call.
+
+    Attributes
+    ----------
+    enabled : bool
+        Whether metrics are being recorded
+    sinks : List[Sink]
+        Where snapshots are sent by export()
+    """
+
+    def __init__(self, enabled: bool = False):
+        """
+        Parameters
+        ----------
+        enabled : bool, default=False
+            Whether metrics are being recorded
+        """
+
+        self.enabled = enabled
+        self.sinks: List[Sink] = []
+        self._counters: Dict[_Key, float] = {}
+        self._gauges: Dict[_Key, float] = {}
+        self._histograms: Dict[_Key, Histogram] = {}
+        self._lock = Lock()
+        self._export_thread: Optional[Thread] = None
+        self._stop_exporting_event = Event()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increase a counter
+
+        Parameters
+        ----------
+        name : str
+            The name of the counter
+        value : float, default=1
+            How much to increase the counter by
+        **labels
+            The labels of the counter
+        """
+
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """Set a gauge (a value that can go up and down, like a queue depth)
+
+        Parameters
+        ----------
+        name : str
+            The name of the gauge
+        value : float
+            The gauge's current value
+        **labels
+            The labels of the gauge
+        """
+
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        """Record a value in a histogram
+
+        Parameters
+        ----------
+        name : str
+            The name of the histogram
+        value : float
+            The observed value (in seconds for latencies)
+        **labels
+            The labels of the histogram
+        """
+
+        if not self.enabled:
+            return
+        self._observe(_key(name, labels), value)
+
+    def _observe(self, key: _Key, value: float):
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def time(self, name: str, **labels):
+        """Get a context manager that records how long its body took in a histogram
+
+        Parameters
+        ----------
+        name : str
+            The name of the histogram
+        **labels
+            The labels of the histogram
+
+        Returns
+        -------
+        A context manager for use in a with statement
+        """
+
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, _key(name, labels))
+
+    def reset(self):
+        """Forget every recorded metric"""
+
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Get a JSON-serializable copy of every metric
+
+        Returns
+        -------
+        Dict[str, Any]
+            The counters, gauges and histograms, each a mapping of metric name to a list of
+            {'labels': {...}, ...} entries
+        """
+
+        def entries(metrics: Dict[_Key, Any], to_dict) -> Dict[str, List[Dict[str, Any]]]:
+            result = {}
+            for (name, labels), metric in sorted(metrics.items()):
+                result.setdefault(name, []).append({'labels': dict(labels), **to_dict(metric)})
+            return result
+
+        with self._lock:
+            return {
+                'time': time.time(),
+                'counters': entries(self._counters, lambda value: {'value': value}),
+                'gauges': entries(self._gauges, lambda value: {'value': value}),
+                'histograms': entries(self._histograms, lambda histogram: {
+                    'buckets': list(histogram.buckets),
+                    'counts': list(histogram.counts),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                }),
+            }
+
+    def add_sink(self, sink: 'Sink'):
+        self.sinks.append(sink)
+
+    def export(self):
+        """Send a snapshot of every metric to every sink"""
+
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.export(snapshot)
+
+    def start_exporting(self, interval: float = 10.0):
+        """Start exporting to the sinks every interval seconds in a background thread
+
+        Parameters
+        ----------
+        interval : float, default=10.0
+            How many seconds to wait in between exports
+        """
+
+        def export_periodically():
+            while not self._stop_exporting_event.wait(interval):
+                self.export()
+
+        self._stop_exporting_event.clear()
+        self._export_thread = Thread(target=export_periodically, daemon=True)
+        self._export_thread.start()
+
+    def stop_exporting(self):
+        """Stop the background export thread, exporting one last time"""
+
+        if self._export_thread is not None:
+            self._stop_exporting_event.set()
+            self._export_thread.join()
+            self._export_thread = None
+        self.export()
+
+
+class Sink(ABC):
+    """The base class of everything metrics can be exported to"""
+
+    @abstractmethod
+    def export(self, snapshot: Dict[str, Any]):
+        """Export a snapshot from Metrics.snapshot()"""
+
+
+class LogSink(Sink):
+    """Logs one line per metric, with histograms summarized by their count and mean
+
+    Attributes
+    ----------
+    logger : logging.Logger
+        The logger to log to
+    level : int
+        The level to log at
+    """
+
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.INFO):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def export(self, snapshot: Dict[str, Any]):
+        for kind in ['counters', 'gauges']:
+            for name, entries in snapshot[kind].items():
+                for entry in entries:
+                    self.logger.log(self.level, '%s%s = %g', name, entry['labels'] or '', entry['value'])
+        for name, entries in snapshot['histograms'].items():
+            for entry in entries:
+                mean_ms = entry['sum'] / entry['count'] * 1000 if entry['count'] else 0.0
+                self.logger.log(self.level, '%s%s: count=%d mean=%.2fms', name, entry['labels'] or '',
+                                entry['count'], mean_ms)
+
+
+class JsonFileSink(Sink):
+    """Overwrites a JSON file with the latest snapshot
+
+    Attributes
+    ----------
+    path : str
+        The path of the JSON file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, snapshot: Dict[str, Any]):
+        # write to a temporary file first so readers never see a half-written file
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(temp_path, self.path)
+
+
+def to_prometheus_text(snapshot: Dict[str, Any]) -> str:
+    """Format a snapshot in the Prometheus text exposition format
+
+    Parameters
+    ----------
+    snapshot : Dict[str, Any]
+        The snapshot to format, from Metrics.snapshot()
+
+    Returns
+    -------
+    str
+        The formatted metrics
+    """
+
+    def label_text(labels: Dict[str, str], **extra) -> str:
+        labels = {**labels, **extra}
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{label}="{value}"' for label, value in labels.items()) + '}'
+
+    lines = []
+    for kind, prometheus_type in [('counters', 'counter'), ('gauges', 'gauge')]:
+        for name, entries in snapshot[kind].items():
+            lines.append(f'# TYPE {name} {prometheus_type}')
+            lines.extend(f'{name}{label_text(entry["labels"])} {entry["value"]}' for entry in entries)
+    for name, entries in snapshot['histograms'].items():
+        lines.append(f'# TYPE {name} histogram')
+        for entry in entries:
+            cumulative = 0
+            for bound, count in zip(list(entry['buckets']) + ['+Inf'], entry['counts']):
+                cumulative += count
+                lines.append(f'{name}_bucket{label_text(entry["labels"], le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{label_text(entry["labels"])} {entry["sum"]}')
+            lines.append(f'{name}_count{label_text(entry["labels"])} {entry["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusSink(Sink):
+    """Serves the latest snapshot over HTTP at /metrics in the Prometheus text format
+
+    Attributes
+    ----------
+    address : Tuple[str, int]
+        The host and port the server is listening on
+    """
+
+    def __init__(self, port: int = 9100, host: str = '0.0.0.0'):
+        """
+        Parameters
+        ----------
+        port : int, default=9100
+            The port to listen on (0 picks a free port)
+        host : str, default='0.0.0.0'
+            The interface to listen on
+        """
+
+        # only loaded when metrics are actually served
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        sink = self
+        self._text = ''
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = sink._text.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # don't print every scrape to the console
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self.address = self._server.server_address
+        Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def export(self, snapshot: Dict[str, Any]):
+        self._text = to_prometheus_text(snapshot)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# the registry used by the Recorder and video_creator, disabled until METRICS.enable() is called
+METRICS = Metrics()
@@ -0,0 +1,59 @@
+import os
+from typing import List, Sequence, Tuple
+
+# reduced-size copies of a channel's images are kept in <channel dir>/proxies/x<factor>/<image name>
+PROXIES_DIR_NAME = 'proxies'
+
+
+def proxy_dir(image_dir: str, factor: int) -> str:
+    """Get the directory that holds a channel's proxies that are shrunk by a factor"""
+
+    return os.path.join(image_dir, PROXIES_DIR_NAME, f'x{factor}')
+
+
+def proxy_path(image_path: str, factor: int) -> str:
+    """Get the path of an image's proxy that is shrunk by a factor"""
+
+    image_dir, image_name = os.path.split(image_path)
+    return os.path.join(proxy_dir(image_dir, factor), image_name)
+
+
+def available_factors(image_dir: str) -> List[int]:
+    """List the proxy shrink factors that a channel directory has, in increasing order"""
+
+    try:
+        names = os.listdir(os.path.join(image_dir, PROXIES_DIR_NAME))
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[1:]) for name in names if name.startswith('x') and name[1:].isdigit())
+
+
+def existing_proxy_paths(image_path: str, factors: Sequence[int]) -> List[str]:
+    """Get the paths of an image's proxies that actually exist"""
+
+    return [path for path in (proxy_path(image_path, factor) for factor in factors) if os.path.isfile(path)]
+
+
+def best_proxy(image_path: str, shrink_factor: int) -> Tuple[str, int]:
+    """Pick the smallest image that can still be shrunk to exactly 1/shrink_factor of the original
+
+    Parameters
+    ----------
+    image_path : str
+        The path of the original image
+    shrink_factor : int
+        How much the caller wants the original shrunk by
+
+    Returns
+    -------
+    Tuple[str, int]
+        The path to read (a proxy or the original itself) and how much it still has to be shrunk by
+    """
+
+    # the largest proxy factor that divides the shrink factor leaves the least left to decode and resize
+    for factor in range(shrink_factor, 1, -1):
+        if shrink_factor % factor == 0:
+            path = proxy_path(image_path, factor)
+            if os.path.isfile(path):
+                return path, shrink_factor // factor
+    return image_path, shrink_factor
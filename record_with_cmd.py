@@ -1,10 +1,12 @@
+import os
+
 from recorder import Recorder
 
 NUM_CAMERAS = 8
 CAPTURE_DELAY = 0.5  # in seconds
 DT_OFFSET = 4  # in seconds
 
-IMAGE_DIRS = ['images'] + [f'images\\ch{i + 1}' for i in range(NUM_CAMERAS)]
+IMAGE_DIRS = ['images'] + [os.path.join('images', f'ch{i + 1}') for i in range(NUM_CAMERAS)]
 
 
 def askyesno(question: str) -> bool:
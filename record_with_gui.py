@@ -1,3 +1,4 @@
+import os
 import time
 import tkinter as tk
 from datetime import timedelta
@@ -12,7 +13,7 @@ NUM_CAMERAS = 8
 CAPTURE_DELAY = 0.5  # in seconds
 DT_OFFSET = 3  # in seconds
 
-IMAGE_DIRS = ['images'] + [f'images\\ch{i + 1}' for i in range(NUM_CAMERAS)]
+IMAGE_DIRS = ['images'] + [os.path.join('images', f'ch{i + 1}') for i in range(NUM_CAMERAS)]
 
 
 class App(tk.Tk):
@@ -0,0 +1,230 @@
+import os
+import shutil
+from datetime import datetime, timedelta
+from itertools import groupby
+from threading import Event, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+from frame_cache import FRAME_CACHE
+from image_collection import ImageCollection
+from metrics import METRICS
+from proxies import available_factors, existing_proxy_paths
+from segments import SEGMENT_EXTENSION, close_segment, list_segments, table_path
+
+
+class RetentionManager:
+    """A class that uses threading to delete the oldest recorded images in the background
+
+    Images are grouped into time buckets (across all channels) and whole buckets are expired
+    oldest first until the recording is back within its budgets. Compacted segments are expired
+    as a whole, in the bucket of their first frame, and images are expired along with their
+    proxies. The bucket currently being recorded into is
+    never touched, and nothing here runs on the Recorder's thread.
+
+    Attributes
+    ----------
+    image_dirs : List[str]
+        The paths of both the root image directory and the channel directories
+    max_bytes : int, optional
+        The most bytes the images may take up in total
+    max_age : timedelta, optional
+        How long to keep images for
+    min_free_bytes : int, optional
+        How many bytes to keep free on the disk the images are stored on
+    bucket_seconds : int
+        How many seconds of images make up one bucket
+    check_interval : float
+        How many seconds to wait in between checking the budgets
+    archive : Callable[[List[str]], None], optional
+        Called with the paths of a bucket's images before they are deleted (e.g. to compact
+        them into a video), the images are kept if it raises an exception
+    verbose : bool
+        Whether to log to the console what is being deleted
+    _sizes : Dict[str, int]
+        The sizes of images that have already been seen, so they don't have to be stat'ed again
+    """
+
+    def __init__(self, image_dirs: List[str], max_bytes: Optional[int] = None, max_age: Optional[timedelta] = None,
+                 min_free_bytes: Optional[int] = None, bucket_seconds: int = 60, check_interval: float = 30.0,
+                 archive: Optional[Callable[[List[str]], None]] = None, verbose: bool = True):
+        """
+        Parameters
+        ----------
+        image_dirs : List[str]
+            The paths of both the root image directory and the channel directories
+        max_bytes : int, optional
+            The most bytes the images may take up in total
+        max_age : timedelta, optional
+            How long to keep images for
+        min_free_bytes : int, optional
+            How many bytes to keep free on the disk the images are stored on
+        bucket_seconds : int, default=60
+            How many seconds of images make up one bucket
+        check_interval : float, default=30.0
+            How many seconds to wait in between checking the budgets
+        archive : Callable[[List[str]], None], optional
+            Called with the paths of a bucket's images before they are deleted (e.g. to compact
+            them into a video), the images are kept if it raises an exception
+        verbose : bool, default=True
+            Whether to log to the console what is being deleted
+        """
+
+        if max_bytes is None and max_age is None and min_free_bytes is None:
+            raise ValueError('at least one of max_bytes, max_age or min_free_bytes must be set')
+
+        self.image_dirs = image_dirs
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_free_bytes = min_free_bytes
+        self.bucket_seconds = bucket_seconds
+        self.check_interval = check_interval
+        self.archive = archive
+        self.verbose = verbose
+
+        self._sizes: Dict[str, int] = {}
+        self._thread: Optional[Thread] = None
+        self._stop_event = Event()
+
+    def _scan(self) -> List[Tuple[datetime, str, int]]:
+        """List every recorded image and segment as (timestamp, path, size), oldest first"""
+
+        images = []
+        seen = set()
+        for image_dir in self.image_dirs[1:]:
+            factors = available_factors(image_dir)
+            try:
+                entries = os.scandir(image_dir)
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if not entry.name.endswith('.jpg'):
+                        continue
+                    try:
+                        dt = ImageCollection.datetime_from_image_name(entry.name)
+                        size = self._sizes.get(entry.path)
+                        if size is None:
+                            size = entry.stat().st_size + sum(os.path.getsize(path) for path in
+                                                              existing_proxy_paths(entry.path, factors))
+                            self._sizes[entry.path] = size
+                    except (ValueError, FileNotFoundError):  # not a recorded image or deleted in the meantime
+                        continue
+                    images.append((dt, entry.path, size))
+                    seen.add(entry.path)
+
+            for segment_path in list_segments(image_dir):
+                try:
+                    dt = ImageCollection.datetime_from_image_name(segment_path)
+                    size = self._sizes.get(segment_path)
+                    if size is None:
+                        size = os.path.getsize(segment_path) + os.path.getsize(table_path(segment_path))
+                        self._sizes[segment_path] = size
+                except (ValueError, FileNotFoundError):
+                    continue
+                images.append((dt, segment_path, size))
+                seen.add(segment_path)
+
+        # forget images that were deleted by someone else
+        for path in self._sizes.keys() - seen:
+            del self._sizes[path]
+
+        images.sort()
+        return images
+
+    def _over_budget(self, total_bytes: int, bucket_end: datetime) -> bool:
+        if self.max_bytes is not None and total_bytes > self.max_bytes:
+            return True
+        if self.max_age is not None and bucket_end < datetime.now() - self.max_age:
+            return True
+        if self.min_free_bytes is not None and shutil.disk_usage(self.image_dirs[0]).free < self.min_free_bytes:
+            return True
+        return False
+
+    def _expire(self, images: List[Tuple[datetime, str, int]]) -> bool:
+        """Archive (if enabled) and delete a bucket of images, returning whether it was deleted"""
+
+        paths = [path for _, path, _ in images]
+        loose_paths = [path for path in paths if not path.endswith(SEGMENT_EXTENSION)]
+        if self.archive is not None and loose_paths:  # segments are already compacted
+            try:
+                self.archive(loose_paths)
+            except Exception as e:
+                print(f'Failed to archive {len(paths)} images starting at {images[0][0]}, keeping them: {e!r}')
+                return False
+
+        factors = {image_dir: available_factors(image_dir) for image_dir in {os.path.dirname(path) for path in paths}}
+        for path in paths:
+            if path.endswith(SEGMENT_EXTENSION):
+                close_segment(path)
+                # delete the table first so the segment is never indexed without it
+                to_remove = [table_path(path), path]
+            else:
+                to_remove = existing_proxy_paths(path, factors[os.path.dirname(path)]) + [path]
+            for removed_path in to_remove:
+                try:
+                    os.remove(removed_path)
+                except FileNotFoundError:
+                    pass
+                FRAME_CACHE.discard(removed_path)
+            self._sizes.pop(path, None)
+
+        METRICS.inc('retention_images_deleted_total', len(paths))
+        METRICS.inc('retention_bytes_deleted_total', sum(size for _, _, size in images))
+        if self.verbose:
+            print(f'Deleted {len(paths)} images from {images[0][0]} to {images[-1][0]}')
+        return True
+
+    def run_once(self) -> int:
+        """Expire the oldest buckets until the images are within every budget
+
+        Returns
+        -------
+        int
+            How many images were deleted
+        """
+
+        images = self._scan()
+        total_bytes = sum(size for _, _, size in images)
+        METRICS.set_gauge('retention_bytes', total_bytes)
+
+        def bucket_of(image: Tuple[datetime, str, int]) -> int:
+            return int(image[0].timestamp() // self.bucket_seconds)
+
+        buckets = [(bucket, list(bucket_images)) for bucket, bucket_images in groupby(images, key=bucket_of)]
+
+        deleted = 0
+        for bucket, bucket_images in buckets[:-1]:  # never touch the bucket currently being recorded into
+            bucket_end = datetime.fromtimestamp((bucket + 1) * self.bucket_seconds)
+            if self._stop_event.is_set() or not self._over_budget(total_bytes, bucket_end):
+                break
+            if not self._expire(bucket_images):
+                break
+            total_bytes -= sum(size for _, _, size in bucket_images)
+            deleted += len(bucket_images)
+
+        METRICS.set_gauge('retention_bytes', total_bytes)
+        return deleted
+
+    def start(self):
+        """Start enforcing the budgets in the background"""
+
+        def enforce():
+            while True:
+                try:
+                    self.run_once()
+                except OSError as e:  # keep going, the disk may just be busy
+                    print(f'Retention check failed: {e!r}')
+                if self._stop_event.wait(self.check_interval):
+                    break
+
+        self._stop_event.clear()
+        self._thread = Thread(target=enforce, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop enforcing the budgets"""
+
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()  # wait for thread to finish
+            self._thread = None
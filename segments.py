@@ -0,0 +1,233 @@
+import csv
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Union
+
+import numpy
+
+# compacted segments of a channel are kept in this subdirectory of the channel's directory
+SEGMENTS_DIR_NAME = 'segments'
+SEGMENT_EXTENSION = '.mp4'
+TABLE_EXTENSION = '.csv'
+
+# how many frames ahead of a reader's position are grabbed instead of seeking
+MAX_SKIP_FRAMES = 48
+
+
+class SegmentFrame(NamedTuple):
+    """A single frame inside a compacted video segment
+
+    Attributes
+    ----------
+    segment_path : str
+        The path of the video segment
+    frame_number : int
+        The position of the frame in the segment, starting at 0
+    """
+
+    segment_path: str
+    frame_number: int
+
+
+def segments_dir(image_dir: str) -> str:
+    """Get the directory that holds the compacted segments of a channel directory"""
+
+    return os.path.join(image_dir, SEGMENTS_DIR_NAME)
+
+
+def table_path(segment_path: str) -> str:
+    """Get the path of the frame-timestamp table that belongs to a segment"""
+
+    return os.path.splitext(segment_path)[0] + TABLE_EXTENSION
+
+
+def write_table(segment_path: str, image_names: List[str]):
+    """Write a segment's frame-timestamp table, which marks the segment as complete
+
+    Parameters
+    ----------
+    segment_path : str
+        The path of the video segment
+    image_names : List[str]
+        The names of the original images (which contain their timestamps), in frame order
+    """
+
+    path = table_path(segment_path)
+    with open(f'{path}.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['frame', 'image_name'])
+        writer.writerows(enumerate(image_names))
+    os.replace(f'{path}.tmp', path)
+
+
+def read_table(segment_path: str) -> List[str]:
+    """Read a segment's frame-timestamp table
+
+    Parameters
+    ----------
+    segment_path : str
+        The path of the video segment
+
+    Returns
+    -------
+    List[str]
+        The names of the original images, in frame order
+    """
+
+    with open(table_path(segment_path), newline='') as f:
+        rows = csv.reader(f)
+        next(rows)  # skip header
+        return [image_name for _, image_name in rows]
+
+
+def list_segments(image_dir: str) -> List[str]:
+    """List the paths of a channel's complete segments (the ones with a frame-timestamp table)"""
+
+    try:
+        names = os.listdir(segments_dir(image_dir))
+    except FileNotFoundError:
+        return []
+    return sorted(os.path.join(segments_dir(image_dir), name) for name in names
+                  if name.endswith(SEGMENT_EXTENSION) and os.path.splitext(name)[0] + TABLE_EXTENSION in names)
+
+
+class _SegmentReader:
+    """Keeps a segment open so that consecutive frames are decoded sequentially instead of seeking"""
+
+    def __init__(self, segment_path: str):
+        import cv2  # only loaded once a segment is actually read, so indexing doesn't pay for it
+
+        self.lock = Lock()
+        self._capture = cv2.VideoCapture(segment_path)
+        self._position = 0  # the frame number the next read() returns
+
+    def read(self, frame_number: int) -> Optional[numpy.ndarray]:
+        if not self._position <= frame_number <= self._position + MAX_SKIP_FRAMES:
+            import cv2
+
+            self._capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            self._position = frame_number
+        while self._position < frame_number:
+            self._capture.grab()
+            self._position += 1
+
+        success, frame = self._capture.read()
+        if not success:  # leave the position unknown so the next read seeks
+            self._position = -MAX_SKIP_FRAMES - 1
+            return None
+        self._position += 1
+        return frame
+
+    def close(self):
+        self._capture.release()
+
+
+_readers: 'OrderedDict[str, _SegmentReader]' = OrderedDict()
+_readers_lock = Lock()
+MAX_OPEN_SEGMENTS = 32
+
+
+def read_frame(frame: SegmentFrame) -> Optional[numpy.ndarray]:
+    """Decode a single frame from a segment
+
+    Readers are kept open between calls, so reading the frames of a segment in order only
+    decodes each frame once.
+
+    Parameters
+    ----------
+    frame : SegmentFrame
+        The frame to decode
+
+    Returns
+    -------
+    numpy.ndarray, optional
+        The decoded cv2-compatible image or None if it couldn't be read
+    """
+
+    with _readers_lock:
+        reader = _readers.get(frame.segment_path)
+        if reader is None:
+            reader = _readers[frame.segment_path] = _SegmentReader(frame.segment_path)
+            while len(_readers) > MAX_OPEN_SEGMENTS:
+                _, closed = _readers.popitem(last=False)
+                with closed.lock:
+                    closed.close()
+        _readers.move_to_end(frame.segment_path)
+
+    with reader.lock:
+        return reader.read(frame.frame_number)
+
+
+def read_frames(segment_path: str, first_frame: int, count: int) -> List[Optional[numpy.ndarray]]:
+    """Decode a run of consecutive frames from a segment with a reader of its own
+
+    Unlike read_frame(), this doesn't share a reader, so runs from the same segment can be
+    decoded in parallel without fighting over (and seeking back and forth in) one reader.
+
+    Parameters
+    ----------
+    segment_path : str
+        The path of the video segment
+    first_frame : int
+        The frame number of the first frame to decode
+    count : int
+        How many frames to decode
+
+    Returns
+    -------
+    List[Optional[numpy.ndarray]]
+        The decoded cv2-compatible images, with None for frames that couldn't be read
+    """
+
+    reader = _SegmentReader(segment_path)
+    try:
+        return [reader.read(frame_number) for frame_number in range(first_frame, first_frame + count)]
+    finally:
+        reader.close()
+
+
+def split_runs(sources: Sequence[Union[str, SegmentFrame]],
+               max_length: Optional[int] = None) -> Iterator[List[Union[str, SegmentFrame]]]:
+    """Split frames into runs that can each be decoded in one go
+
+    A run is either loose JPEGs or consecutive frames of a single segment, which read_frames()
+    decodes sequentially.
+
+    Parameters
+    ----------
+    sources : Sequence[Union[str, SegmentFrame]]
+        The frames, as loose JPEG paths or frames inside segments
+    max_length : int, optional
+        The most frames in a run, default is no limit
+
+    Returns
+    -------
+    Iterator[List[Union[str, SegmentFrame]]]
+        The runs, in order
+    """
+
+    run = []
+    for source in sources:
+        if run:
+            previous = run[-1]
+            same_run = (isinstance(source, SegmentFrame) and isinstance(previous, SegmentFrame) and
+                        source.segment_path == previous.segment_path and
+                        source.frame_number == previous.frame_number + 1) or \
+                       (isinstance(source, str) and isinstance(previous, str))
+            if not same_run or len(run) == max_length:
+                yield run
+                run = []
+        run.append(source)
+    if run:
+        yield run
+
+
+def close_segment(segment_path: str):
+    """Close a segment's reader if it's open, e.g. before the segment is deleted"""
+
+    with _readers_lock:
+        reader = _readers.pop(segment_path, None)
+    if reader is not None:
+        with reader.lock:
+            reader.close()
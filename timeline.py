@@ -0,0 +1,134 @@
+from datetime import datetime
+from typing import Dict, NamedTuple, Optional, Union
+
+import numpy
+
+
+class TimelinePlan(NamedTuple):
+    """Which source frame fills each slot of an output video
+
+    Attributes
+    ----------
+    slot_times : numpy.ndarray
+        The time every output slot represents, as datetime64[us]
+    frame_indices : numpy.ndarray
+        The index (into the planned timestamps) of the frame that fills every slot, or -1 if no
+        frame is close enough
+    errors : numpy.ndarray
+        How many seconds every slot's frame is away from the slot's time (NaN for empty slots)
+    """
+
+    slot_times: numpy.ndarray
+    frame_indices: numpy.ndarray
+    errors: numpy.ndarray
+
+    def report(self, num_frames: Optional[int] = None) -> Dict[str, float]:
+        """Summarize how faithful the plan is to the source timestamps
+
+        Parameters
+        ----------
+        num_frames : int, optional
+            How many source frames there are, needed to count the frames that were dropped
+
+        Returns
+        -------
+        Dict[str, float]
+            The number of slots, the mean and max time error in seconds, how many slots repeat the
+            previous slot's frame, how many slots are empty and (if num_frames is given) how many
+            source frames don't appear in any slot
+        """
+
+        filled = self.frame_indices[self.frame_indices >= 0]
+        report = {
+            'slots': len(self.frame_indices),
+            'mean_error_s': float(numpy.nanmean(self.errors)) if len(filled) else 0.0,
+            'max_error_s': float(numpy.nanmax(self.errors)) if len(filled) else 0.0,
+            'duplicated_slots': int(numpy.count_nonzero((self.frame_indices[1:] == self.frame_indices[:-1]) &
+                                                        (self.frame_indices[1:] >= 0))),
+            'empty_slots': int(numpy.count_nonzero(self.frame_indices < 0)),
+        }
+        if num_frames is not None:
+            report['dropped_frames'] = num_frames - len(numpy.unique(filled))
+        return report
+
+
+def _to_datetime64(dt: Union[datetime, numpy.datetime64]) -> numpy.datetime64:
+    return numpy.datetime64(dt, 'us')
+
+
+def planned_fps(timestamps: numpy.ndarray) -> float:
+    """Estimate a channel's capture rate from the median gap between its timestamps
+
+    Unlike calculate_fps() in video_creator, long gaps from stalls don't drag this estimate down.
+
+    Parameters
+    ----------
+    timestamps : numpy.ndarray
+        The sorted timestamps of the frames, as datetime64
+
+    Returns
+    -------
+    float
+        The estimated framerate
+    """
+
+    gaps = numpy.diff(timestamps) / numpy.timedelta64(1, 'us') / 1e6
+    gaps = gaps[gaps > 0]
+    return 1 / float(numpy.median(gaps)) if len(gaps) else 1.0
+
+
+def plan_timeline(timestamps: numpy.ndarray, fps: float, start: Optional[Union[datetime, numpy.datetime64]] = None,
+                  end: Optional[Union[datetime, numpy.datetime64]] = None,
+                  max_seconds_apart: Optional[float] = None) -> TimelinePlan:
+    """Pick the source frame closest in time to every slot of an output video at a fixed fps
+
+    Playing the output back at fps then matches wall time: frames are repeated to cover gaps
+    (stalls) and skipped where frames came in faster than fps. Everything is computed with
+    vectorized numpy operations, so planning a full day takes milliseconds.
+
+    Parameters
+    ----------
+    timestamps : numpy.ndarray
+        The sorted timestamps of the source frames, as datetime64 (e.g. ChannelIndex.timestamps)
+    fps : float
+        The framerate of the output video
+    start : datetime, optional
+        The time of the first slot, default is the first timestamp
+    end : datetime, optional
+        The time of the last slot (inclusive), default is the last timestamp
+    max_seconds_apart : float, optional
+        Leave slots empty (-1) whose closest frame is further away than this, default is to
+        always use the closest frame
+
+    Returns
+    -------
+    TimelinePlan
+    """
+
+    timestamps = numpy.asarray(timestamps, dtype='datetime64[us]')
+    if len(timestamps) == 0 and (start is None or end is None):
+        raise ValueError('start and end are required when there are no timestamps')
+    start = _to_datetime64(start) if start is not None else timestamps[0]
+    end = _to_datetime64(end) if end is not None else timestamps[-1]
+
+    period = numpy.timedelta64(int(round(1e6 / fps)), 'us')
+    num_slots = int((end - start) // period) + 1
+    slot_times = start + numpy.arange(num_slots) * period
+
+    if len(timestamps) == 0:
+        return TimelinePlan(slot_times, numpy.full(num_slots, -1), numpy.full(num_slots, numpy.nan))
+
+    # the closest frame is either the first frame at or after the slot or the one right before it
+    after = numpy.clip(numpy.searchsorted(timestamps, slot_times), 0, len(timestamps) - 1)
+    before = numpy.clip(after - 1, 0, len(timestamps) - 1)
+    after_error = numpy.abs(timestamps[after] - slot_times)
+    before_error = numpy.abs(timestamps[before] - slot_times)
+    frame_indices = numpy.where(before_error <= after_error, before, after)
+    errors = numpy.minimum(before_error, after_error) / numpy.timedelta64(1, 'us') / 1e6
+
+    if max_seconds_apart is not None:
+        too_far = errors > max_seconds_apart
+        frame_indices = numpy.where(too_far, -1, frame_indices)
+        errors = numpy.where(too_far, numpy.nan, errors)
+
+    return TimelinePlan(slot_times, frame_indices, errors)
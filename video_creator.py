@@ -1,12 +1,20 @@
 import concurrent.futures
 import os
-from datetime import timedelta, datetime
-from typing import Optional, Tuple, Literal, Union, List
+import queue
+from collections import deque
+from threading import Event, Thread
+from typing import Optional, Tuple, Literal, Union, List, Dict
 
 import cv2
 import numpy
 
-from image_collection import ImageCollection
+from activity import activity_scores
+from channel_index import ChannelIndex, FrameSource
+from frame_cache import FrameCache
+from image_collection import ImageCollection, NUM_CAMERAS
+from metrics import METRICS
+from segments import SegmentFrame, read_frames, split_runs
+from timeline import TimelinePlan, plan_timeline, planned_fps
 
 
 def calculate_fps(image_names: List[str]) -> float:
@@ -25,8 +33,9 @@ def calculate_fps(image_names: List[str]) -> float:
 
 
 def single_channel(channel: int, images_dir: Optional[str] = None, output_file: Optional[str] = None,
-                   fps: Union[int, Literal['auto']] = 'auto'):
-    """Combines all the images in a single channel's directory into one video
+                   fps: Union[int, Literal['auto']] = 'auto',
+                   timestamp_faithful: bool = False, fourcc: str = 'mp4v') -> Optional[Dict[str, float]]:
+    """Combines all the images in a single channel's directory (including compacted segments) into one video
 
     Parameters
     ----------
@@ -39,33 +48,151 @@ def single_channel(channel: int, images_dir: Optional[str] = None, output_file:
     fps : int, 'auto'
         Either a set fps or 'auto' for automatic fps calculation based on how
         long passed between each image capture
+    timestamp_faithful : bool, default=False
+        Whether to repeat or skip images so that the video plays back in step with the images'
+        timestamps (see timeline.plan_timeline()) instead of writing every image exactly once
+    fourcc : str, default='mp4v'
+        The codec to compress the video with
+
+    Returns
+    -------
+    Dict[str, float], optional
+        How far the video's timing is off from the images' timestamps (see TimelinePlan.report()),
+        only if timestamp_faithful is True
+
+    Raises
+    ------
+    IOError
+        If the video can't be opened for writing (e.g. the codec isn't available)
     """
 
     image_folder = os.path.join(images_dir or 'images', f'ch{channel}')
-    images = os.listdir(image_folder)
+    index = ChannelIndex.load(image_folder)
     video_name = output_file or f'ch{channel}.mp4'
 
     # auto fps calculator
-    fps = calculate_fps(images) if fps == 'auto' else fps
+    if timestamp_faithful:
+        fps = planned_fps(index.timestamps) if fps == 'auto' else fps
+        plan = plan_timeline(index.timestamps, fps)
+        frame_indices = plan.frame_indices
+    else:
+        fps = calculate_fps(index.names) if fps == 'auto' else fps
+        frame_indices = range(len(index))
 
     # get the dimensions of the first image to set up the VideoWriter
-    frame = cv2.imread(os.path.join(image_folder, images[0]))
+    frame = FrameCache.decode(index[0])
     height, width, layers = frame.shape
-    video = cv2.VideoWriter(video_name, 0, fps, (width, height))
-
-    # write all the images to the video
-    for image in images:
-        video.write(cv2.imread(os.path.join(image_folder, image)))
+    video = cv2.VideoWriter(video_name, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+    if not video.isOpened():
+        raise IOError(f'Unable to open {video_name} for writing with the {fourcc} codec')
+
+    # write all the images to the video (segment frames are decoded sequentially), repeated images
+    # are written again without decoding them again
+    previous_frame_index = None
+    for frame_index in frame_indices:
+        if frame_index != previous_frame_index:
+            with METRICS.time('video_stage_seconds', stage='decode', video=video_name):
+                frame = FrameCache.decode(index[frame_index])
+            previous_frame_index = frame_index
+        with METRICS.time('video_stage_seconds', stage='write', video=video_name):
+            video.write(frame)
+        METRICS.inc('video_frames_written_total', video=video_name)
 
     # save the video
     video.release()
 
+    if timestamp_faithful:
+        # noinspection PyUnboundLocalVariable
+        return plan.report(len(index))
+
+
+def _plan_grid(images_dir: Optional[str], fps: Union[int, Literal['auto']]) \
+        -> Tuple[List[str], List[Optional[ChannelIndex]], List[TimelinePlan], float]:
+    """Plan which image of every channel fills each slot of a grid video
+
+    When to start and when to stop is determined by the datetime of the first and last images in
+    ch1, and every channel fills the same slots with its closest images (within 1 second).
+    """
+
+    images_dir = images_dir or 'images'
+    image_dirs = [os.path.join(images_dir, f'ch{i + 1}') for i in range(NUM_CAMERAS)]
+    indexes = [ChannelIndex.load(image_dir) if os.path.isdir(image_dir) else None for image_dir in image_dirs]
+    ch1_index = indexes[0]
+
+    # auto fps calculator, from the median gap so that stalls don't drag it down
+    fps = planned_fps(ch1_index.timestamps) if fps == 'auto' else fps
+
+    start, end = ch1_index.timestamps[0], ch1_index.timestamps[-1]
+    plans = [plan_timeline(index.timestamps if index is not None else [], fps, start, end, 1) for index in indexes]
+    return image_dirs, indexes, plans, fps
+
+
+def _write_grid_video(video_name: str, fps: float, indexes: List[Optional[ChannelIndex]],
+                      frame_indices: numpy.ndarray, max_pending: Optional[int] = None, fourcc: str = 'mp4v'):
+    """Write a video of image grids, one per row of frame_indices (-1 for a channel without an image)
+
+    At most max_pending grids (default is twice the number of CPUs) are rendered ahead of the
+    writer, so memory use doesn't grow with the length of the video. Raises IOError if the video
+    can't be opened for writing with the fourcc codec.
+    """
+
+    # only render a grid when a slot's images differ from the previous slot's
+    changes = numpy.flatnonzero(numpy.any(frame_indices[1:] != frame_indices[:-1], axis=1)) + 1
+    starts = numpy.concatenate([[0], changes])
+    repeats = numpy.diff(numpy.concatenate([starts, [len(frame_indices)]]))
+
+    # for use in the thread pool
+    def create_image_grid(slot: int) -> Optional[numpy.ndarray]:
+        image_paths = [index[i] if i >= 0 else None for index, i in zip(indexes, frame_indices[slot])]
+        if not any(image_paths):  # every channel has a gap here
+            return None
+        with METRICS.time('video_stage_seconds', stage='grid', video=video_name):
+            return ImageCollection(image_paths).to_cv2_image_grid(2)
+
+    video = None
+    blank = None
+
+    def write(image: Optional[numpy.ndarray], repeat: int):
+        nonlocal video, blank
+        if video is None:
+            # get the dimensions of the first image grid to set up the VideoWriter
+            height, width, layers = image.shape
+            video = cv2.VideoWriter(video_name, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+            if not video.isOpened():
+                raise IOError(f'Unable to open {video_name} for writing with the {fourcc} codec')
+            blank = numpy.zeros_like(image)
+        for _ in range(repeat):
+            with METRICS.time('video_stage_seconds', stage='write', video=video_name):
+                video.write(image if image is not None else blank)
+            METRICS.inc('video_frames_written_total', video=video_name)
+
+    # create image grids in a thread pool through a bounded window, writing them in order as soon as they are ready
+    max_pending = max_pending or 2 * (os.cpu_count() or 1)
+    pending = deque()
+    try:
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            for start, repeat in zip(starts, repeats):
+                pending.append((executor.submit(create_image_grid, start), repeat))
+                if len(pending) >= max_pending:
+                    future, oldest_repeat = pending.popleft()
+                    write(future.result(), oldest_repeat)
+            while pending:
+                future, oldest_repeat = pending.popleft()
+                write(future.result(), oldest_repeat)
+    finally:
+        # save the video
+        if video is not None:
+            video.release()
+
 
 def all_channels(images_dir: Optional[str] = None, output_file: Optional[str] = None,
-                 fps: Union[int, Literal['auto']] = 'auto'):
+                 fps: Union[int, Literal['auto']] = 'auto', fourcc: str = 'mp4v') -> Dict[str, Dict[str, float]]:
     """Creates a video made up of ImageCollection image grids from all the images taken
 
-    This function uses the ImageCollection.from_timestamp() class method
+    Like the ImageCollection.from_timestamp() class method, every grid shows the image from each
+    channel that is closest to the grid's time (within 1 second), but the images for every grid
+    are planned up front from each channel's timestamps with timeline.plan_timeline(), and
+    consecutive grids that would show the same images are only rendered once.
 
     Parameters
     ----------
@@ -76,43 +203,102 @@ def all_channels(images_dir: Optional[str] = None, output_file: Optional[str] =
     fps : int, 'auto'
         Either a set fps or 'auto' for automatic fps calculation based on how
         long passed between each image capture
+    fourcc : str, default='mp4v'
+        The codec to compress the video with
+
+    Returns
+    -------
+    Dict[str, Dict[str, float]]
+        How far each channel's timing is off from its images' timestamps (see TimelinePlan.report()),
+        keyed by channel directory
+
+    Raises
+    ------
+    IOError
+        If the video can't be opened for writing (e.g. the codec isn't available)
     """
 
-    ch1_images = os.listdir(os.path.join(images_dir or 'images', 'ch1'))
     video_name = output_file or 'all_channels.mp4'
+    image_dirs, indexes, plans, fps = _plan_grid(images_dir, fps)
+    _write_grid_video(video_name, fps, indexes, numpy.stack([plan.frame_indices for plan in plans], axis=1),
+                      fourcc=fourcc)
 
-    # auto fps calculator
-    fps = calculate_fps(ch1_images) if fps == 'auto' else fps
-
-    # get the dimensions of one image grid to set up the VideoWriter
-    test_frame = ImageCollection.from_index(0).to_cv2_image_grid(2)
-    height, width, layers = test_frame.shape
-    video = cv2.VideoWriter(video_name, 0, fps, (width, height))
-
-    # when to start and when to stop is determined by the datetime of the first and last images in ch1
-    current_dt = ImageCollection.datetime_from_image_name(ch1_images[0])
-    end_dt = ImageCollection.datetime_from_image_name(ch1_images[-1])
+    return {image_dir: plan.report(len(index) if index is not None else 0)
+            for image_dir, plan, index in zip(image_dirs, plans, indexes)}
 
-    # pre-calculate the datetimes necessary
-    total_seconds = (end_dt - current_dt).total_seconds()
-    dts = (current_dt + timedelta(seconds=i) for i in numpy.arange(0, total_seconds, fps ** -1))
 
-    # for use in the thread pool
-    def create_image_grid(dt: datetime) -> Tuple[datetime, numpy.ndarray]:
-        collection = ImageCollection.from_timestamp(dt, 1)
-        open_cv_image = collection.to_cv2_image_grid(2)
-        return dt, open_cv_image
+def summary(images_dir: Optional[str] = None, output_file: Optional[str] = None,
+            fps: Union[int, Literal['auto']] = 'auto', activity_threshold: float = 2.0, idle_speedup: int = 20,
+            padding_seconds: float = 2.0, max_workers: Optional[int] = None, fourcc: str = 'mp4v') -> Dict[str, float]:
+    """Creates a grid video like all_channels() that only plays active periods at normal speed
 
-    # create image grids in a thread pool
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = executor.map(create_image_grid, dts)
+    Every frame gets a cheap activity score (see activity.activity_scores(), which caches them), and
+    a slot of the video counts as active when any channel's image in it scores at least
+    activity_threshold. Active slots (plus padding_seconds on either side) are all written, while
+    idle stretches only keep every idle_speedup-th slot, turning them into a timelapse.
 
-    # write images to a video
-    for _, image in sorted(results, key=lambda x: x[0]):
-        video.write(image)
+    Parameters
+    ----------
+    images_dir : str, optional
+        The root directory of all the images
+    output_file : str, optional
+        The filename (or path) of the video to create
+    fps : int, 'auto'
+        Either a set fps or 'auto' for automatic fps calculation based on how
+        long passed between each image capture
+    activity_threshold : float, default=2.0
+        The mean absolute difference (0-255) from the previous image that counts as activity
+    idle_speedup : int, default=20
+        How many times faster than normal idle stretches are played
+    padding_seconds : float, default=2.0
+        How many seconds before and after activity to also play at normal speed
+    max_workers : int, optional
+        How many threads score images, default is one per CPU
+    fourcc : str, default='mp4v'
+        The codec to compress the video with
+
+    Returns
+    -------
+    Dict[str, float]
+        How many slots the full recording has, how many of them are active, how many frames were
+        written and how many seconds long the summary is
+
+    Raises
+    ------
+    IOError
+        If the video can't be opened for writing (e.g. the codec isn't available)
+    """
 
-    # save the video
-    video.release()
+    video_name = output_file or 'summary.mp4'
+    image_dirs, indexes, plans, fps = _plan_grid(images_dir, fps)
+    frame_indices = numpy.stack([plan.frame_indices for plan in plans], axis=1)
+
+    # a slot's activity is the highest score of the images in it
+    slot_activity = numpy.zeros(len(frame_indices))
+    for channel, index in enumerate(indexes):
+        if index is None or len(index) == 0:
+            continue
+        scores = activity_scores(index, max_workers)
+        channel_indices = frame_indices[:, channel]
+        slot_activity = numpy.maximum(slot_activity, numpy.where(channel_indices >= 0, scores[channel_indices], 0))
+
+    # pad the active periods, then keep every active slot and every idle_speedup-th idle slot
+    padding = int(round(padding_seconds * fps))
+    # (a cumulative sum counts the active slots within padding of every slot, keeping the array's length)
+    active_counts = numpy.concatenate([[0], numpy.cumsum(slot_activity >= activity_threshold)])
+    positions = numpy.arange(len(slot_activity))
+    window_starts = numpy.clip(positions - padding, 0, len(slot_activity))
+    window_ends = numpy.clip(positions + padding + 1, 0, len(slot_activity))
+    active = active_counts[window_ends] > active_counts[window_starts]
+    keep = active | (numpy.arange(len(frame_indices)) % idle_speedup == 0)
+    _write_grid_video(video_name, fps, indexes, frame_indices[keep], fourcc=fourcc)
+
+    return {
+        'slots': len(frame_indices),
+        'active_slots': int(numpy.count_nonzero(active)),
+        'frames_written': int(numpy.count_nonzero(keep)),
+        'duration_s': float(numpy.count_nonzero(keep) / fps),
+    }
 
 
 def all_channels_basic(images_dir: Optional[str] = None, output_file: Optional[str] = None,
@@ -132,7 +318,7 @@ def all_channels_basic(images_dir: Optional[str] = None, output_file: Optional[s
         long passed between each image capture
     """
 
-    ch1_images = os.listdir(os.path.join(images_dir or 'images', 'ch1'))
+    ch1_images = ChannelIndex.load(os.path.join(images_dir or 'images', 'ch1')).names
     video_name = output_file or 'all_channels.mp4'
 
     # auto fps calculator
@@ -145,8 +331,10 @@ def all_channels_basic(images_dir: Optional[str] = None, output_file: Optional[s
 
     # for use in the thread pool
     def create_image_grid(index: int) -> Tuple[int, numpy.ndarray]:
-        collection = ImageCollection.from_index(index)
-        open_cv_image = collection.to_cv2_image_grid(2)
+        with METRICS.time('video_stage_seconds', stage='lookup', video=video_name):
+            collection = ImageCollection.from_index(index)
+        with METRICS.time('video_stage_seconds', stage='grid', video=video_name):
+            open_cv_image = collection.to_cv2_image_grid(2)
         return index, open_cv_image
 
     # create image grids in a thread pool
@@ -155,7 +343,149 @@ def all_channels_basic(images_dir: Optional[str] = None, output_file: Optional[s
 
     # write images to a video
     for _, image in sorted(results, key=lambda x: x[0]):
-        video.write(image)
+        with METRICS.time('video_stage_seconds', stage='write', video=video_name):
+            video.write(image)
+        METRICS.inc('video_frames_written_total', video=video_name)
 
     # save the video
     video.release()
+
+
+def _decode_chunk(chunk: List[FrameSource]) -> List[Optional[numpy.ndarray]]:
+    """Decode a run of frames from split_runs()"""
+
+    with METRICS.time('video_stage_seconds', stage='decode_chunk'):
+        if isinstance(chunk[0], SegmentFrame):
+            return read_frames(chunk[0].segment_path, chunk[0].frame_number, len(chunk))
+        return [FrameCache.decode(source) for source in chunk]
+
+
+def export_all_channels(images_dir: Optional[str] = None, output_dir: Optional[str] = None,
+                        fps: Union[int, Literal['auto']] = 'auto', channels: Optional[List[int]] = None,
+                        max_workers: Optional[int] = None, queue_size: int = 4, chunk_size: int = 16,
+                        fourcc: str = 'mp4v') -> List[str]:
+    """Creates one video per channel, like single_channel(), but for every channel at the same time
+
+    Every channel gets its own encoder thread, and all of them share one pool of decode workers.
+    Each channel's decoded frames pass through a bounded queue in order, so memory use stays
+    bounded no matter how long the recording is.
+
+    Parameters
+    ----------
+    images_dir : str, optional
+        The root directory of all the images
+    output_dir : str, optional
+        The directory to create the videos (ch1.mp4, ch2.mp4, ...) in
+    fps : int, 'auto'
+        Either a set fps or 'auto' for automatic fps calculation (per channel) based on how
+        long passed between each image capture
+    channels : List[int], optional
+        The channels to create videos of, default is every channel
+    max_workers : int, optional
+        How many threads decode images, default is one per CPU
+    queue_size : int, default=4
+        How many decoded chunks each channel can have waiting to be written
+    chunk_size : int, default=16
+        How many frames each decode task handles
+    fourcc : str, default='mp4v'
+        The codec to compress the videos with
+
+    Returns
+    -------
+    List[str]
+        The paths of the created videos (channels without images are skipped)
+
+    Raises
+    ------
+    IOError
+        If a video can't be opened for writing (e.g. the codec isn't available)
+    """
+
+    images_dir = images_dir or 'images'
+    output_dir = output_dir or '.'
+    os.makedirs(output_dir, exist_ok=True)
+    channels = channels or [i + 1 for i in range(NUM_CAMERAS)]
+    failed = Event()
+    errors = []
+    video_names = []
+
+    def put(channel_queue: queue.Queue, item) -> bool:
+        """Put an item in a queue, giving up if another channel has failed"""
+
+        while not failed.is_set():
+            try:
+                channel_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def export(channel: int, decode_pool: concurrent.futures.ThreadPoolExecutor):
+        video = None
+        try:
+            image_folder = os.path.join(images_dir, f'ch{channel}')
+            if not os.path.isdir(image_folder):
+                return
+            index = ChannelIndex.load(image_folder)
+            if len(index) == 0:
+                return
+            channel_fps = calculate_fps(index.names) if fps == 'auto' and len(index) > 1 else fps
+            if channel_fps == 'auto':  # a single image
+                channel_fps = 1
+            video_name = os.path.join(output_dir, f'ch{channel}.mp4')
+            channel_queue = queue.Queue(maxsize=queue_size)
+
+            # submit decodes in order, the bounded queue keeps this from running too far ahead of the writer
+            def produce():
+                for chunk in split_runs(index.sources, chunk_size):
+                    if not put(channel_queue, decode_pool.submit(_decode_chunk, chunk)):
+                        return
+                put(channel_queue, None)
+
+            producer = Thread(target=produce, daemon=True)
+            producer.start()
+
+            while True:
+                future = channel_queue.get()
+                METRICS.set_gauge('export_queue_depth', channel_queue.qsize(), channel=channel)
+                if future is None:
+                    break
+                for frame in future.result():
+                    if frame is None:  # unreadable image
+                        METRICS.inc('export_frames_skipped_total', channel=channel)
+                        continue
+                    if video is None:
+                        height, width = frame.shape[:2]
+                        video = cv2.VideoWriter(video_name, cv2.VideoWriter_fourcc(*fourcc), channel_fps,
+                                                (width, height))
+                        if not video.isOpened():
+                            raise IOError(f'Unable to open {video_name} for writing with the {fourcc} codec')
+                    elif frame.shape[:2] != (height, width):
+                        # noinspection PyUnboundLocalVariable
+                        frame = cv2.resize(frame, (width, height))
+                    with METRICS.time('video_stage_seconds', stage='write', video=video_name):
+                        video.write(frame)
+                    METRICS.inc('video_frames_written_total', video=video_name)
+                if failed.is_set():
+                    break
+
+            producer.join()
+            if video is not None and not failed.is_set():
+                video_names.append(video_name)
+        except BaseException as e:
+            errors.append(e)
+            failed.set()
+        finally:
+            if video is not None:
+                video.release()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as decode_pool:
+        threads = [Thread(target=export, args=(channel, decode_pool)) for channel in channels]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return sorted(video_names)